@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 from pathlib import Path
 import json
 import os
+import tempfile
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -137,6 +138,38 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 STATIC_URL = '/static/'
 
+# `collectstatic` writes content-hashed copies of the static files plus
+# precompressed .gz/.br variants, served with immutable cache headers
+# (Electrum/storage.py)
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "Electrum.storage.CompressedManifestStaticFilesStorage",
+    },
+}
+
+
+# File uploads
+# https://docs.djangoproject.com/en/3.2/ref/settings/#file-upload-max-memory-size
+
+# Uploaded MIDAS tables larger than this are streamed to a temporary file
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
+
+# Largest MIDAS table accepted by the substructure enrichment endpoint
+ELECTRUM_MAX_UPLOAD_SIZE = int(config.get("MAX_UPLOAD_SIZE", 50 * 1024 * 1024))
+
+# Background substructure enrichment: spooled tables and job results, and
+# the number of worker processes per web worker
+ELECTRUM_JOB_PATH = config.get("JOB_PATH", os.path.join(tempfile.gettempdir(), "electrum-substructure"))
+ELECTRUM_JOB_WORKERS = int(config.get("JOB_WORKERS", 2))
+
+# Spooled tables and job results unused for this many seconds are removed,
+# as are the least recently used ones once the directory exceeds this size
+ELECTRUM_JOB_MAX_AGE = int(config.get("JOB_MAX_AGE", 24 * 60 * 60))
+ELECTRUM_JOB_MAX_SIZE = int(config.get("JOB_MAX_SIZE", 2 * 1024 * 1024 * 1024))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
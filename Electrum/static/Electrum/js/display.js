@@ -21,11 +21,15 @@ this program.  If not, see <https://www.gnu.org/licenses/>.
 const selector = "#graph";
 
 // MAIN --> Change URL to HTTPS URL when data is public
-let data_url = "static/Electrum/data/MIDAS-latest.txt";
-let mapper_url = "static/Electrum/data/HSA-latest.eldb";
-let metabolite_url = "static/Electrum/data/metabolites.json";
-let protein_url = "static/Electrum/data/proteins.json";
-let order_url = "static/Electrum/data/radial_order.txt";
+// Pages set DATA_URLS (templates/Electrum/data_urls.html) to the
+// content-hashed names written by collectstatic, which are cached for good
+const data_urls = (typeof DATA_URLS !== "undefined") ? DATA_URLS : {};
+let data_id = "MIDAS-latest.txt";
+let data_url = data_urls.data || "static/Electrum/data/MIDAS-latest.txt";
+let mapper_url = data_urls.mapper || "static/Electrum/data/HSA-latest.eldb";
+let metabolite_url = data_urls.metabolites || "static/Electrum/data/metabolites.json";
+let protein_url = data_urls.proteins || "static/Electrum/data/proteins.json";
+let order_url = data_urls.order || "static/Electrum/data/radial_order.txt";
 
 // add drop-down menu and selection determines input data table for construction
 Promise.all([
@@ -34,7 +38,8 @@ Promise.all([
   d3.json(metabolite_url),
   d3.json(protein_url),
   d3.tsv(order_url),
-  data_url
+  data_url,
+  data_id
 ]).then(function(data) {
   let midasGraph = new MIDASgraph(data);
 }).catch(function(error) {
@@ -25,7 +25,34 @@ var background_forward = true;
 var toggle_scaling = false;
 var show_intra_pathway = true;
 var q_threshold = 0.1;
+var use_substructure_hierarchy = false;
 var reader = new FileReader();
+const METABOLITE_FORMAT = 2;
+
+// metabolites.json format 2 stores each record once (values in `fields`
+// order) and maps aliases to record indices; expand it to alias -> record
+// so lookups match the original layout
+function unpack_metabolites(reference) {
+
+  if (reference.format !== METABOLITE_FORMAT) {
+    return reference;
+  }
+
+  let fields = reference.fields;
+  let records = reference.records.map(function(values) {
+    let record = {};
+    for (let i = 0; i < fields.length; i++) {
+      record[fields[i]] = values[i];
+    }
+    return record;
+  });
+
+  let metabolites = {};
+  for (let alias in reference.aliases) {
+    metabolites[alias] = records[reference.aliases[alias]];
+  }
+  return metabolites;
+}
 
 class MIDASgraph {
 
@@ -33,10 +60,14 @@ class MIDASgraph {
     // Set constructor keys
     this.graphData = graph_data[0];
     this.metaboverseData = graph_data[1];
-    this.metabolites_reference = graph_data[2];
+    this.metabolites_reference = unpack_metabolites(graph_data[2]);
     this.protein_reference = graph_data[3];
     this.radial_order = graph_data[4].map(({Metabolites}) => Metabolites);
 
+    // Bundled tables are registered server-side by their original file
+    // name, not the content-hashed name they are fetched from
+    this.datasetID = graph_data[6];
+
     fetch(graph_data[5])
       .then(res => res.blob())
       .then(blob => {
@@ -68,6 +99,7 @@ class MIDASgraph {
         });
         that.graphData = data;
         that.dataURL = file;
+        that.datasetID = null;
         that.dataForm = document.querySelector('input[type=file]');
         that.dataBuffer = arrayBuffer;
 
@@ -99,6 +131,9 @@ class MIDASgraph {
       that.init_data();
       draw_graph(that);
     });
+    d3.select("#toggle_hierarchy").on("click", function() {
+      use_substructure_hierarchy = modVar(use_substructure_hierarchy);
+    });
     d3.select("#toggle_scaling").on("click", function() {
       toggle_scaling = modVar(toggle_scaling);
       draw_graph(that);
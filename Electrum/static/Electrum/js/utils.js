@@ -22,6 +22,7 @@ const _hmdb_url = "https://hmdb.ca/metabolites/";
 const _uniprot_url = "https://www.uniprot.org/uniprot/";
 const _reactome_url = "https://reactome.org/content/detail/";
 const SPINNER_TARGET = "svg_viewer_id";
+const SUBSTRUCTURE_POLL_INTERVAL = 500; // ms between substructure job status checks
 
 // Spinner.js settings 
 const opts = { // Spinner opts from http://spin.js.org/
@@ -748,72 +749,142 @@ function display_substructure_results(this_protein, this_data) {
   modal_body.innerHTML += d.display_name;
   modal_body.innerHTML += '</i></span></b><br>';
 
-  let formData = new FormData();
-  formData.append('this_data', '>>>this_data<<<');
-  formData.append('protein', d.display_name);
-  formData.append('threshold', q_threshold);
-
-  console.log(this_data)
-  formData.append('file', this_data.dataURL, this_data.dataURL.name);
+  const spinner = new Spinner(opts);
 
   // Run substructure
-  $.ajax({
-    headers: { "X-CSRFToken": getCookie("csrftoken") },
-    url: 'ajax/run_substructure/',
-    data: formData,
-    cache: false,
-    contentType: 'multipart/form-data; charset=utf-8; boundary="random_boundary_key"',
-    processData: false,
-    type: 'POST',
-    success: function (d) {
-      // Parse results that pass the q-value threshold
-      let results = {};
-      for (let ID in d["CHEMONTID"]) {
-        //let criteria = "FDR";
-        let criteria = "P_value";
-        if (d[criteria][ID] < q_threshold) {
-          results[ID] = {
-            ID: ID,
-            NAME: d["Term"][ID],
-            FOLDCHANGE: d["Fold_change"][ID],
-            PVALUE: d["P_value"][ID],
-            FDR: d["FDR"][ID]
-          }
+  // The run is queued on the server and its job ID polled until the results
+  // are ready. Once the server has a table only its dataset ID is posted;
+  // the table is uploaded again if the server no longer has it
+  function run_substructure(upload) {
+    let formData = new FormData();
+    formData.append('protein', d.display_name);
+    formData.append('threshold', q_threshold);
+    formData.append('hierarchy', use_substructure_hierarchy);
+    formData.append('async', true);
+    if (upload) {
+      formData.append('file', this_data.dataURL, this_data.dataURL.name);
+    } else {
+      formData.append('dataset_id', this_data.datasetID);
+    }
+
+    spinner.spin(modal_body);
+    $.ajax({
+      headers: { "X-CSRFToken": getCookie("csrftoken") },
+      url: 'ajax/run_substructure/',
+      data: formData,
+      cache: false,
+      contentType: false,
+      processData: false,
+      type: 'POST',
+      success: function (job) {
+        this_data.datasetID = job.dataset_id;
+        poll_substructure(job.job_id, upload);
+      },
+      error: function (xhr) {
+        spinner.stop();
+        if (!upload && xhr.status === 404) {
+          this_data.datasetID = null;
+          run_substructure(true);
+        } else {
+          show_substructure_error(xhr);
         }
       }
+    });
+  }
 
-      // Sort output
-      var sorted_results = [];
-      for (let key in results) {
-        sorted_results.push([ key, results[key], results[key]["FOLDCHANGE"] ]);
+  function poll_substructure(job_id, upload) {
+    $.ajax({
+      url: 'ajax/substructure_job/' + job_id + '/',
+      cache: false,
+      type: 'GET',
+      success: function (d, status, xhr) {
+        if (xhr.status === 202) {
+          setTimeout(function() {
+            poll_substructure(job_id, upload);
+          }, SUBSTRUCTURE_POLL_INTERVAL);
+        } else {
+          spinner.stop();
+          show_substructure_results(d);
+        }
+      },
+      error: function (xhr) {
+        spinner.stop();
+        // Job results expired on the server; queue it again
+        if (!upload && xhr.status === 404) {
+          run_substructure(!this_data.datasetID);
+        } else {
+          show_substructure_error(xhr);
+        }
       }
-      sorted_results.sort(function compare(kv1, kv2) {
-        return kv2[2] - kv1[2];
-      })
+    });
+  }
+
+  function show_substructure_error(xhr) {
+    // Failed jobs and rejected requests carry the reason in `error`
+    let message = "Unable to run substructure enrichment analysis.";
+    if (xhr.responseJSON && xhr.responseJSON.error) {
+      message += " (" + xhr.responseJSON.error + ")";
+    } else if (xhr.status === 0) {
+      message += " (server could not be reached)";
+    }
+    let cell = document.createElement("td");
+    cell.textContent = message;
 
-      // Display results
-      var display_table = "<br><table style='width:90%; text-align:left'><tr><th>Substructure</th><th>Fold Change</th><th>p-value</th><th>FDR</th></tr>";
+    modal_body.innerHTML += "<br><table style='width:90%; text-align:left'><tr>"
+      + cell.outerHTML + "</tr></table><br><br>";
+  }
 
-      if (sorted_results.length === 0) {
-        display_table +=  "<tr><td>No results to display</td></tr>";
+  function show_substructure_results(d) {
+    // Parse results that pass the q-value threshold
+    let results = {};
+    for (let ID in d["CHEMONTID"]) {
+      //let criteria = "FDR";
+      let criteria = "P_value";
+      if (d[criteria][ID] < q_threshold) {
+        results[ID] = {
+          ID: ID,
+          NAME: d["Term"][ID],
+          FOLDCHANGE: d["Fold_change"][ID],
+          PVALUE: d["P_value"][ID],
+          FDR: d["FDR"][ID]
+        }
       }
+    }
 
-      for (let RESULT in sorted_results) {
-        _RESULT = sorted_results[RESULT][1];
+    // Sort output
+    var sorted_results = [];
+    for (let key in results) {
+      sorted_results.push([ key, results[key], results[key]["FOLDCHANGE"] ]);
+    }
+    sorted_results.sort(function compare(kv1, kv2) {
+      return kv2[2] - kv1[2];
+    })
 
-        var tr = "<tr>";
-        tr += "<td>" + _RESULT["NAME"] + "</td>";
-        tr += "<td>" + _RESULT["FOLDCHANGE"].toFixed(2) + "</td>";
-        tr += "<td>" + _RESULT["PVALUE"].toExponential(2) + "</td>";
-        tr += "<td>" + _RESULT["FDR"].toExponential(2) + "</td>";
-        tr += "</tr>";
-        display_table += tr;
+    // Display results
+    var display_table = "<br><table style='width:90%; text-align:left'><tr><th>Substructure</th><th>Fold Change</th><th>p-value</th><th>FDR</th></tr>";
 
-      }
+    if (sorted_results.length === 0) {
+      display_table +=  "<tr><td>No results to display</td></tr>";
+    }
+
+    for (let RESULT in sorted_results) {
+      _RESULT = sorted_results[RESULT][1];
+
+      var tr = "<tr>";
+      tr += "<td>" + _RESULT["NAME"] + "</td>";
+      tr += "<td>" + _RESULT["FOLDCHANGE"].toFixed(2) + "</td>";
+      tr += "<td>" + _RESULT["PVALUE"].toExponential(2) + "</td>";
+      tr += "<td>" + _RESULT["FDR"].toExponential(2) + "</td>";
+      tr += "</tr>";
+      display_table += tr;
 
-      modal_body.innerHTML += display_table + "</table><br><br>";
     }
-  });
+
+    modal_body.innerHTML += display_table + "</table><br><br>";
+  }
+
+  console.log(this_data)
+  run_substructure(!this_data.datasetID);
 
 
 
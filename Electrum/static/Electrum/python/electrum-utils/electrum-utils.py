@@ -35,9 +35,15 @@ __path__ = os.path.dirname(
 
 """Internal dependencies 
 """
+# Shared enrichment modules live next to electrum-utils in substructure_enrich
+sys.path.insert(0, os.path.join(__path__, '..'))
+
 from make_entity_dictionary.__main__ import __main__ as makeEntityDictionary
 from make_structure_dictionary.__main__ import __main__ as makeStructureDictionary
 from make_heatmap.__main__ import __main__ as makeRadialGuide
+from make_contingency_tables.__main__ import __main__ as makeContingencyTables
+from make_enrichment_report.__main__ import __main__ as makeEnrichmentReport
+from make_compiled_references.__main__ import __main__ as makeCompiledReferences
 
 
 """Functions 
@@ -61,6 +67,12 @@ def parse_args(
         +---------------------------------+---------------------------------------------------+
         |   buildRadialGuide              |   Build radial position guide for metabolites     |
         +---------------------------------+---------------------------------------------------+
+        |   buildContingencyTables        |   Precompute substructure enrichment tables       |
+        +---------------------------------+---------------------------------------------------+
+        |   buildEnrichmentReport         |   Substructure enrichment for every protein       |
+        +---------------------------------+---------------------------------------------------+
+        |   compileReferences             |   Compile JSON references to memory-mapped tables |
+        +---------------------------------+---------------------------------------------------+
     """
 
     license_info = """\
@@ -135,6 +147,39 @@ def parse_args(
         metavar='<path>',
         type=str,
         required=True)
+
+    # buildEntityReference optional arguments
+    entity_opts = entity_parser.add_argument_group('optional arguments')
+    entity_opts.add_argument(
+        '-e', '--endpoint',
+        help='URL of the MetaboAnalyst compound mapper, or a compatible local stand-in (default: https://www.xialab.ca/api/mapcompounds)',
+        metavar='<url>',
+        type=str,
+        required=False)
+    entity_opts.add_argument(
+        '--chunk-size',
+        help='Number of metabolite names sent per request (default: 200)',
+        metavar='<int>',
+        type=int,
+        default=200,
+        required=False)
+    entity_opts.add_argument(
+        '-w', '--workers',
+        help='Number of requests sent concurrently (default: 4)',
+        metavar='<int>',
+        type=int,
+        default=4,
+        required=False)
+    entity_opts.add_argument(
+        '-c', '--cache',
+        help='Directory for cached name mappings, so reruns only query new names (default: ~/.cache/electrum-utils)',
+        metavar='<path>',
+        type=str,
+        required=False)
+    entity_opts.add_argument(
+        '--no-cache',
+        help='Query every name and do not store the results',
+        action='store_true')
     
 
     # buildSubstructureReference parser
@@ -152,6 +197,28 @@ def parse_args(
         type=str,
         required=True)
 
+    # buildSubstructureReference optional arguments
+    substructure_opts = substructure_parser.add_argument_group('optional arguments')
+    substructure_opts.add_argument(
+        '-w', '--workers',
+        help='Number of processes used to parse the HMDB SDF file (default: 1)',
+        metavar='<int>',
+        type=int,
+        default=1,
+        required=False)
+    substructure_opts.add_argument(
+        '-c', '--cache',
+        help='Path to directory where source archives are kept between runs (default: ~/.cache/electrum-utils)',
+        metavar='<path>',
+        type=str,
+        required=False)
+    substructure_opts.add_argument(
+        '-m', '--mirror',
+        help='Path to directory with pre-fetched source archives; no downloads are made',
+        metavar='<path>',
+        type=str,
+        required=False)
+
     # buildRadialGuide parser
     radial_parser = subparser.add_parser(
         'buildRadialGuide',
@@ -172,6 +239,123 @@ def parse_args(
         metavar='<path>',
         type=str,
         required=True)
+
+    # buildRadialGuide optional arguments
+    radial_opts = radial_parser.add_argument_group('optional arguments')
+    radial_opts.add_argument(
+        '--metric',
+        help='Distance metric between metabolite profiles, any scipy pdist metric (default: euclidean)',
+        metavar='<metric>',
+        type=str,
+        default='euclidean',
+        required=False)
+    radial_opts.add_argument(
+        '--method',
+        help='Hierarchical clustering linkage method (default: complete)',
+        choices=['single', 'complete', 'average', 'weighted', 'centroid', 'median', 'ward'],
+        default='complete',
+        required=False)
+    radial_opts.add_argument(
+        '--optimal-ordering',
+        help='Reorder dendrogram leaves so neighbouring metabolites are most similar (changes the radial order)',
+        action='store_true')
+    radial_opts.add_argument(
+        '--rebuild',
+        help='Recompute all distances instead of updating those saved in radial_order.npz by a previous run',
+        action='store_true')
+    
+
+    # buildContingencyTables parser
+    contingency_parser = subparser.add_parser(
+        'buildContingencyTables',
+        description='Precompute per-protein substructure enrichment contingency tables',
+        add_help=False)
+
+    # buildContingencyTables required arguments
+    contingency_reqs = contingency_parser.add_argument_group('required arguments')
+    contingency_reqs.add_argument(
+        '-d', '--database',
+        help='Path and filename of MIDAS interaction database (must be tab-delimited)',
+        metavar='<path/filename.txt>',
+        type=str,
+        required=True)
+    contingency_reqs.add_argument(
+        '-o', '--output',
+        help='Path to output directory (default: current working directory)',
+        metavar='<path>',
+        type=str,
+        required=True)
+
+    # buildContingencyTables optional arguments
+    contingency_opts = contingency_parser.add_argument_group('optional arguments')
+    contingency_opts.add_argument(
+        '-r', '--reference',
+        help='Path to directory with metabolites.json and CHEMONTID-substructure-table.npz (default: Electrum data directory)',
+        metavar='<path>',
+        type=str,
+        required=False)
+    contingency_opts.add_argument(
+        '--hierarchy',
+        help='Propagate substructure annotations to all parent classes using CHEMONTID-hierarchy-dictionary.json',
+        action='store_true')
+    
+
+    # buildEnrichmentReport parser
+    report_parser = subparser.add_parser(
+        'buildEnrichmentReport',
+        description='Run substructure enrichment for every query protein in a MIDAS database',
+        add_help=False)
+
+    # buildEnrichmentReport required arguments
+    report_reqs = report_parser.add_argument_group('required arguments')
+    report_reqs.add_argument(
+        '-d', '--database',
+        help='Path and filename of MIDAS interaction database (must be tab-delimited)',
+        metavar='<path/filename.txt>',
+        type=str,
+        required=True)
+    report_reqs.add_argument(
+        '-o', '--output',
+        help='Path to output directory (default: current working directory)',
+        metavar='<path>',
+        type=str,
+        required=True)
+
+    # buildEnrichmentReport optional arguments
+    report_opts = report_parser.add_argument_group('optional arguments')
+    report_opts.add_argument(
+        '-t', '--threshold',
+        help='q-value threshold for observed interactions (default: 0.1)',
+        metavar='<float>',
+        type=float,
+        default=0.1,
+        required=False)
+    report_opts.add_argument(
+        '-r', '--reference',
+        help='Path to directory with metabolites.json and CHEMONTID-substructure-table.npz (default: Electrum data directory)',
+        metavar='<path>',
+        type=str,
+        required=False)
+    report_opts.add_argument(
+        '--hierarchy',
+        help='Propagate substructure annotations to all parent classes using CHEMONTID-hierarchy-dictionary.json',
+        action='store_true')
+    
+
+    # compileReferences parser
+    compile_parser = subparser.add_parser(
+        'compileReferences',
+        description='Compile JSON reference files into memory-mapped tables shared by server workers',
+        add_help=False)
+
+    # compileReferences optional arguments
+    compile_opts = compile_parser.add_argument_group('optional arguments')
+    compile_opts.add_argument(
+        '-r', '--reference',
+        help='Path to directory with metabolites.json and CHEMONTID-mapper.json (default: Electrum data directory)',
+        metavar='<path>',
+        type=str,
+        required=False)
     
 
     # Get arguments are print help if no arguments provided
@@ -189,6 +373,8 @@ def parse_args(
         args_dict['path'] = args_dict['path'] + os.path.sep
 
     for k, v in args_dict.items():
+        if not isinstance(v, str):
+            continue
         if os.path.isdir(os.path.abspath(v)) \
         or os.path.isfile(os.path.abspath(v)):
             args_dict[k] = os.path.abspath(v)
@@ -218,6 +404,15 @@ def main(
     elif args_dict['cmd'] == 'buildRadialGuide':
         print("\n-> Running buildRadialGuide sub-module\n")
         makeRadialGuide(args_dict)
+    elif args_dict['cmd'] == 'buildContingencyTables':
+        print("\n-> Running buildContingencyTables sub-module\n")
+        makeContingencyTables(args_dict)
+    elif args_dict['cmd'] == 'buildEnrichmentReport':
+        print("\n-> Running buildEnrichmentReport sub-module\n")
+        makeEnrichmentReport(args_dict)
+    elif args_dict['cmd'] == 'compileReferences':
+        print("\n-> Running compileReferences sub-module\n")
+        makeCompiledReferences(args_dict)
     else:
         raise Exception('Invalid sub-module selected')
 
@@ -0,0 +1,97 @@
+"""License Information
+electrum-utils
+Back-end utils tool for Electrum
+https://github.com/Electrum-app/Electrum/
+alias: electrum-utils
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from substructure_enrich.substructure_enrich import COMPILED_REFERENCES, METABOLITE_REFERENCE, CHEMONTID_DICTIONARY, SUBSTRUCTURE_DICTIONARY, DATA_PATH, import_json
+from substructure_enrich.substructures import SubstructureTableWriter, SUBSTRUCTURE_COLUMNS
+from substructure_enrich.columnar import RecordMapping, StringMapping, save_columns
+from substructure_enrich.names import read_reference, write_name_index
+import os
+
+
+"""Functions
+"""
+def compile_substructure_dictionary(
+        substructure_dictionary,
+        output_file):
+    """Convert a JSON substructure dictionary to a SubstructureTable
+    """
+    writer = SubstructureTableWriter()
+    for hmdb_id, record in substructure_dictionary.items():
+        writer.append({
+            c: record.get(c) if isinstance(record.get(c), str) else ''
+            for c in SUBSTRUCTURE_COLUMNS})
+    return writer.save(output_file)
+
+
+def compile_references(
+        reference_path=DATA_PATH):
+    """Compile each JSON reference in `reference_path` to its mapped table
+
+    Returns the paths of the tables written
+    """
+    compilers = {
+        METABOLITE_REFERENCE: lambda d, f: save_columns(f, RecordMapping.compile(d)),
+        CHEMONTID_DICTIONARY: lambda d, f: save_columns(f, StringMapping.compile(d)),
+        SUBSTRUCTURE_DICTIONARY: compile_substructure_dictionary,
+    }
+    readers = {
+        METABOLITE_REFERENCE: read_reference,
+    }
+
+    output_files = []
+    for _file, (compiled_file, _) in COMPILED_REFERENCES.items():
+        if not os.path.isfile(os.path.join(reference_path, _file)):
+            continue
+        reader = readers.get(_file, import_json)
+        output_files.append(compilers[_file](
+            reader(reference_path, _file),
+            os.path.join(reference_path, compiled_file)))
+
+    # Name index over metabolites.json, with SDF synonyms when available
+    if os.path.isfile(os.path.join(reference_path, METABOLITE_REFERENCE)):
+        output_files.append(write_name_index(
+            _path=reference_path,
+            metabolite_file=METABOLITE_REFERENCE))
+
+    return output_files
+
+
+def __main__(
+        args_dict):
+    """Compile the JSON reference files into memory-mapped tables
+
+    metabolites.json and CHEMONTID-mapper.json (and a substructure
+    dictionary from older builds, if present) are written next to the JSON
+    files as `.npz` string tables, along with the metabolite name index
+    (which adds the synonyms in Substructures-DB-latest.txt if present).
+    Every server worker maps the same table from the page cache instead of
+    parsing its own copy of the JSON, so memory use does not grow with the
+    worker count. Recompile whenever the JSON references change; stale
+    tables are ignored until then.
+    """
+
+    reference_path = args_dict.get("reference") or DATA_PATH
+    if not os.path.isdir(reference_path):
+        raise Exception("Provided reference location cannot be found:", reference_path)
+
+    for output_file in compile_references(
+            reference_path=reference_path):
+        print("Compiled", output_file)
+    print("\nProcessing complete.")
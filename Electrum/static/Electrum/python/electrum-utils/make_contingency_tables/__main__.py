@@ -0,0 +1,94 @@
+"""License Information
+electrum-utils
+Back-end utils tool for Electrum
+https://github.com/Electrum-app/Electrum/
+alias: electrum-utils
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from substructure_enrich.substructure_enrich import ReferenceStore, crossref_database_file, DATA_PATH
+from substructure_enrich.contingency import ContingencyTables
+import os
+
+
+"""Functions
+"""
+def build_contingency_tables(
+        database_url,
+        reference_path=DATA_PATH,
+        hierarchy=False):
+    """Cross-reference a MIDAS table and build its per-protein contingency tables
+
+    The tables record a hash of the reference files used, so they are only
+    served while those references are unchanged
+    """
+    references = ReferenceStore(_path=reference_path)
+    dataset_id, \
+    unified_table, \
+    library_size = crossref_database_file(
+        database_url=database_url,
+        references=references,
+        hierarchy=hierarchy)
+
+    return ContingencyTables.from_table(
+        unified_table=unified_table,
+        library_size=library_size,
+        dataset_id=dataset_id,
+        hierarchy=hierarchy,
+        reference_hash=references.annotation_hash(hierarchy))
+
+
+def __main__(
+        args_dict):
+    """Precompute substructure enrichment contingency tables for a MIDAS dataset
+
+    Stores each protein's q-values in sorted order with the CHEMONTIDs of each
+    row, so enrichment at any q-value threshold is a lookup rather than a
+    pass through the pandas pipeline. The tables are tied to the dataset's
+    content hash and to a hash of the reference files, and are only used at
+    runtime while both match; rebuild them whenever the MIDAS table or the
+    substructure reference files change.
+    With `--hierarchy` the tables serve parent-class (hierarchy) enrichment.
+
+    Excepted database format:
+
+                              metabolite query_protein  log2_abundance  log2_abundance_corrected  met_mean    met_sd       p_value       q_value
+        0               metabolite_name1 protein_name1       -3.145748                 -2.583616 -0.041294  0.134860  2.850000e-79  1.930000e-76
+        1               metabolite_name2 protein_name1       -2.049392                 -1.224692 -0.038301  0.122482  3.450000e-22  5.740000e-20
+
+    - Input database file should be tab-delimited with the file suffix `.txt` or `.tsv`
+    - Header naming must be strictly followed
+    """
+
+    if not os.path.isdir(args_dict["output"]):
+        raise Exception("Provided output location cannot be found:", args_dict["output"])
+    if not os.path.isfile(args_dict["database"]):
+        raise Exception("Provided database file location cannot be found:", args_dict["database"])
+
+    reference_path = args_dict.get("reference") or DATA_PATH
+    if not os.path.isdir(reference_path):
+        raise Exception("Provided reference location cannot be found:", reference_path)
+
+    tables = build_contingency_tables(
+        database_url=args_dict["database"],
+        reference_path=reference_path,
+        hierarchy=bool(args_dict.get("hierarchy")))
+
+    output_file = tables.save(
+        _path=args_dict["output"])
+    print(
+        "Stored contingency tables for", len(tables.proteins),
+        "proteins at", output_file)
+    print("\nProcessing complete.")
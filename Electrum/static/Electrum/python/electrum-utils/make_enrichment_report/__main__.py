@@ -0,0 +1,80 @@
+"""License Information
+electrum-utils
+Back-end utils tool for Electrum
+https://github.com/Electrum-app/Electrum/
+alias: electrum-utils
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from substructure_enrich.substructure_enrich import ReferenceStore, crossref_database_file, batch_enrichment, DATA_PATH
+import os
+
+ENRICHMENT_REPORT = "Substructure-enrichment-latest.txt"
+
+
+"""Functions
+"""
+def __main__(
+        args_dict):
+    """Run substructure enrichment for every query protein in a MIDAS database
+
+    All proteins are scored in a single pass (see `batch_enrichment`) and
+    written as one long-form, tab-delimited table with a `query_protein`
+    column, sorted by protein and P-value. With `--hierarchy` each metabolite
+    also counts towards every parent class of its substructures.
+
+    Excepted database format:
+
+                              metabolite query_protein  log2_abundance  log2_abundance_corrected  met_mean    met_sd       p_value       q_value
+        0               metabolite_name1 protein_name1       -3.145748                 -2.583616 -0.041294  0.134860  2.850000e-79  1.930000e-76
+        1               metabolite_name2 protein_name1       -2.049392                 -1.224692 -0.038301  0.122482  3.450000e-22  5.740000e-20
+
+    - Input database file should be tab-delimited with the file suffix `.txt` or `.tsv`
+    - Header naming must be strictly followed
+    """
+
+    if not os.path.isdir(args_dict["output"]):
+        raise Exception("Provided output location cannot be found:", args_dict["output"])
+    if not os.path.isfile(args_dict["database"]):
+        raise Exception("Provided database file location cannot be found:", args_dict["database"])
+
+    reference_path = args_dict.get("reference") or DATA_PATH
+    if not os.path.isdir(reference_path):
+        raise Exception("Provided reference location cannot be found:", reference_path)
+
+    references = ReferenceStore(
+        _path=reference_path)
+    hierarchy = bool(args_dict.get("hierarchy"))
+    _, \
+    unified_table, \
+    library_size = crossref_database_file(
+        database_url=args_dict["database"],
+        references=references,
+        hierarchy=hierarchy)
+
+    results_table = batch_enrichment(
+        unified_table=unified_table,
+        chemontid_reference=references.term_reference(hierarchy),
+        THRESHOLD=float(args_dict["threshold"]),
+        library_size=library_size)
+
+    results_table.to_csv(
+        os.path.join(args_dict["output"], ENRICHMENT_REPORT),
+        sep='\t',
+        index=False)
+    print(
+        "Scored", len(results_table), "substructures across",
+        results_table["query_protein"].nunique(), "proteins")
+    print("\nProcessing complete.")
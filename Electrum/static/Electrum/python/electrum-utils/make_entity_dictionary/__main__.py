@@ -18,8 +18,14 @@ PARTICULAR PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import pandas as pd 
+from substructure_enrich.midas_table import MidasTable
+from substructure_enrich.columnar import RecordMapping, save_columns
+from substructure_enrich.names import write_name_index, write_reference
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+import hashlib
 import json 
 import math
 import re
@@ -35,6 +41,14 @@ HEADERS = {
     'Content-Type': "application/json",
     'cache-control': "no-cache",
 }
+CHUNK_SIZE = 200
+WORKERS = 4
+RETRIES = 5
+BACKOFF = 1.0
+TIMEOUT = 120
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+NAME_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "electrum-utils")
 CUSTOM_NAMES = {
     "D-Glucose": "Glucose",
     "D-Fructose 6-phosphate": "G6P", 
@@ -62,17 +76,12 @@ CUSTOM_NAMES = {
 def parse_identifiers(
         database_url):
 
-    db = pd.read_csv(
-            database_url,
-            sep="\t",
-            index_col=False,
-            header=0
-        )
-    unique_metabolites = db[METABOLITE_HEADER].unique().tolist()
-    unique_proteins = db[PROTEIN_HEADER].unique().tolist()
+    db = MidasTable.read(database_url)
+    unique_metabolites = db.metabolites.tolist()
+    unique_proteins = db.proteins.tolist()
     
     isoforms_reference = {}
-    isoforms = db[METABOLITE_HEADER].loc[db[METABOLITE_HEADER].str.contains(";")].unique().tolist()
+    isoforms = [m for m in unique_metabolites if ";" in m]
     for i in isoforms:
         isoform_list = i.split(";")
         for s in isoform_list:
@@ -83,54 +92,206 @@ def parse_identifiers(
     return unique_metabolites, unique_proteins, isoforms_reference
 
 
+def chunk_names(
+        names,
+        chunk_size=CHUNK_SIZE):
+    """Split a list of names into lists of at most `chunk_size` names
+    """
+    return [
+        names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+
+
+def make_session(
+        workers=WORKERS,
+        retries=RETRIES,
+        backoff=BACKOFF):
+    """Return a pooled HTTP session that retries failed requests
+
+    Connection errors and 429/5xx responses are retried `retries` times
+    with exponential backoff starting at `backoff` seconds.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=workers,
+        pool_maxsize=workers,
+        max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def query_metaboanalyst(
+        session,
+        names,
+        url=METABOANALYST_URL,
+        timeout=TIMEOUT):
+    """Map one chunk of names with the MetaboAnalyst compound mapper
+
+    Returns one row (a dictionary of `Query`, `Match`, `HMDB`, ...) per name
+    keyed by the name sent, or by the row's `Query` if the mapper did not
+    return exactly one row per name.
+    """
+    payload = json.dumps({
+        "queryList": ";".join(names) + ";",
+        "inputType": "name"})
+    response = session.post(
+        url,
+        data=payload,
+        timeout=timeout)
+    response.raise_for_status()
+
+    # The mapper returns one list per field
+    columns = response.json()
+    fields = list(columns)
+    rows = [
+        dict(zip(fields, values))
+        for values in zip(*[columns[f] for f in fields])]
+
+    if len(rows) == len(names):
+        return dict(zip(names, rows))
+    return {row["Query"]: row for row in rows}
+
+
+def read_name_cache(
+        cache_file):
+    """Read cached mapper rows, one JSON line per name; later lines win
+    """
+    results = {}
+    if cache_file is None or not os.path.isfile(cache_file):
+        return results
+    with open(cache_file) as _f:
+        for line in _f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line from an interrupted run
+                continue
+            results[entry["name"]] = entry["row"]
+    return results
+
+
+def append_name_cache(
+        cache_file,
+        results):
+    """Append mapper rows for newly queried names to the cache
+    """
+    if cache_file is None:
+        return
+    with open(cache_file, "a") as _f:
+        for name, row in results.items():
+            _f.write(json.dumps({"name": name, "row": row}) + "\n")
+
+
+def name_cache_file(
+        cache_path,
+        url=METABOANALYST_URL):
+    """Return the cache file for an endpoint, so endpoints never share results
+    """
+    if cache_path is None:
+        return None
+    os.makedirs(cache_path, exist_ok=True)
+    return os.path.join(
+        cache_path,
+        "metaboanalyst-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ".jsonl")
+
+
 def crossref_metaboanalyst(
-        metabolites):
-    
+        metabolites,
+        url=METABOANALYST_URL,
+        cache_path=NAME_CACHE,
+        chunk_size=CHUNK_SIZE,
+        workers=WORKERS,
+        retries=RETRIES,
+        backoff=BACKOFF):
+    """Map metabolite names to HMDB, ChEBI and KEGG IDs with MetaboAnalyst
+
+    Names (isoform lists are split on `;`) are sent in chunks of
+    `chunk_size`, `workers` at a time, over one pooled session. Each name's
+    result is cached in `cache_path` per endpoint, so reruns only query
+    names not seen before; pass `cache_path=None` to disable the cache.
+    `url` selects the endpoint, e.g. a local stand-in for builds and tests.
+    """
     print("Cross-referencing unique metabolites with MetaboAnalyst database...")
-    
-    # Send metabolites to MetaboAnalyst
-    payload_string = ""
-    for x in metabolites:
-        payload_string = payload_string + x + ";"
-
-    payload = "{\n\t\"queryList\": \"" + payload_string + "\",\n\t\"inputType\": \"name\"\n}"
-    metaboanalyst_response = requests.request(
-        "POST", 
-        METABOANALYST_URL, 
-        data=payload, 
-        headers=HEADERS)
-
-    metaboanalyst_df = pd.DataFrame.from_dict(
-        json.loads(metaboanalyst_response.text),
-        orient='index').transpose()
+
+    names = list(dict.fromkeys(
+        n for m in metabolites for n in m.split(";") if n != ""))
+    cache_file = name_cache_file(
+        cache_path=cache_path,
+        url=url)
+    results = read_name_cache(cache_file)
+    queries = [n for n in names if n not in results]
+    print(len(names) - len(queries), "names cached,", len(queries), "to query")
+
+    # Send chunks concurrently; results are cached as each chunk completes
+    if len(queries) > 0:
+        chunks = chunk_names(queries, chunk_size)
+        with make_session(workers, retries, backoff) as session, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(query_metaboanalyst, session, chunk, url)
+                for chunk in chunks]
+            for future in as_completed(futures):
+                chunk_results = future.result()
+                append_name_cache(cache_file, chunk_results)
+                results.update(chunk_results)
 
     # Construct metabolite synonym and ID dictionary from MetaboAnalyst output
     metaboanalyst_dict = {}
-    for index, row in metaboanalyst_df.iterrows():
-
-        name = row["Query"]
-        display_name = name
-        if display_name in CUSTOM_NAMES:
-            display_name = CUSTOM_NAMES[display_name]
-        alt_name = row["Match"]
-        hmdb = row["HMDB"]
-        chebi = row["ChEBI"]
-        kegg = row["KEGG"]
-        smiles = row["SMILES"]
-
-        # Handle NAs
-        if alt_name == "NA" or alt_name == None:
-            alt_name = row["Query"]
-        if hmdb == "NA" or hmdb == None:
-            hmdb = ""
-        if chebi == "NA" or chebi == None:
-            chebi = ""
-        if kegg == "NA" or kegg == None:
-            kegg = ""
-        if smiles == "NA" or smiles == None:
-            smiles = ""
-
-        metaboanalyst_dict[name] = {
+    for name in names:
+        if name in results:
+            add_metaboanalyst_entry(
+                metaboanalyst_dict=metaboanalyst_dict,
+                row=results[name])
+
+    return metaboanalyst_dict
+
+
+def add_metaboanalyst_entry(
+        metaboanalyst_dict,
+        row):
+    """Add one MetaboAnalyst row to the synonym and ID dictionary
+    """
+    name = row["Query"]
+    display_name = name
+    if display_name in CUSTOM_NAMES:
+        display_name = CUSTOM_NAMES[display_name]
+    alt_name = row["Match"]
+    hmdb = row["HMDB"]
+    chebi = row["ChEBI"]
+    kegg = row["KEGG"]
+    smiles = row["SMILES"]
+
+    # Handle NAs
+    if alt_name == "NA" or alt_name == None:
+        alt_name = row["Query"]
+    if hmdb == "NA" or hmdb == None:
+        hmdb = ""
+    if chebi == "NA" or chebi == None:
+        chebi = ""
+    if kegg == "NA" or kegg == None:
+        kegg = ""
+    if smiles == "NA" or smiles == None:
+        smiles = ""
+
+    metaboanalyst_dict[name] = {
+        "name": display_name,
+        "alt_name": alt_name,
+        "hmdb_id": hmdb,
+        "chebi_id": chebi,
+        "kegg_id": kegg,
+        "smiles": smiles
+    }
+
+    if alt_name != name:
+        metaboanalyst_dict[alt_name] = {
             "name": display_name,
             "alt_name": alt_name,
             "hmdb_id": hmdb,
@@ -139,48 +300,36 @@ def crossref_metaboanalyst(
             "smiles": smiles
         }
 
-        if alt_name != name:
-            metaboanalyst_dict[alt_name] = {
-                "name": display_name,
-                "alt_name": alt_name,
-                "hmdb_id": hmdb,
-                "chebi_id": chebi,
-                "kegg_id": kegg,
-                "smiles": smiles
-            }
-
-        # Add flexible search names to dictionary
-        name_label = re.sub(r'\W+', '', name)
-        alt_name_label = re.sub(r'\W+', '', alt_name)
-        
-        if alt_name_label != "":
-            metaboanalyst_dict[name_label.lower()] = {
-                "name": display_name,
-                "alt_name": alt_name,
-                "hmdb_id": hmdb,
-                "chebi_id": chebi,
-                "kegg_id": kegg,
-                "smiles": smiles
-            }
-            metaboanalyst_dict[alt_name_label.lower()] = {
-                "name": display_name,
-                "alt_name": alt_name,
-                "hmdb_id": hmdb,
-                "chebi_id": chebi,
-                "kegg_id": kegg,
-                "smiles": smiles
-            }
-        else:
-            metaboanalyst_dict[name_label.lower()] = {
-                "name": display_name,
-                "alt_name": alt_name,
-                "hmdb_id": hmdb,
-                "chebi_id": chebi,
-                "kegg_id": kegg,
-                "smiles": smiles
-            }
-
-    return metaboanalyst_dict
+    # Add flexible search names to dictionary
+    name_label = re.sub(r'\W+', '', name)
+    alt_name_label = re.sub(r'\W+', '', alt_name)
+    
+    if alt_name_label != "":
+        metaboanalyst_dict[name_label.lower()] = {
+            "name": display_name,
+            "alt_name": alt_name,
+            "hmdb_id": hmdb,
+            "chebi_id": chebi,
+            "kegg_id": kegg,
+            "smiles": smiles
+        }
+        metaboanalyst_dict[alt_name_label.lower()] = {
+            "name": display_name,
+            "alt_name": alt_name,
+            "hmdb_id": hmdb,
+            "chebi_id": chebi,
+            "kegg_id": kegg,
+            "smiles": smiles
+        }
+    else:
+        metaboanalyst_dict[name_label.lower()] = {
+            "name": display_name,
+            "alt_name": alt_name,
+            "hmdb_id": hmdb,
+            "chebi_id": chebi,
+            "kegg_id": kegg,
+            "smiles": smiles
+        }
 
 
 def __main__(
@@ -211,10 +360,23 @@ def __main__(
         database_url=args_dict["database"])
 
     # Cross-reference database metabolites with MetaboAnalyst to build synonym/ID searcher
+    cache_path = args_dict.get("cache") or NAME_CACHE
+    if args_dict.get("no_cache"):
+        cache_path = None
     metaboanalyst_output = crossref_metaboanalyst(
-        metabolites=unique_metabolites)
+        metabolites=unique_metabolites,
+        url=args_dict.get("endpoint") or METABOANALYST_URL,
+        cache_path=cache_path,
+        chunk_size=int(args_dict.get("chunk_size") or CHUNK_SIZE),
+        workers=int(args_dict.get("workers") or WORKERS))
 
-    # Output reference file 
-    with open(os.path.join(args_dict["output"], "metabolites.json"), "w") as fp:
-        json.dump(metaboanalyst_output, fp, sort_keys=True, indent=2)
+    # Output reference file, each record stored once with its aliases
+    write_reference(
+        metaboanalyst_output,
+        os.path.join(args_dict["output"], "metabolites.json"))
+    save_columns(
+        os.path.join(args_dict["output"], "metabolites.npz"),
+        RecordMapping.compile(metaboanalyst_output))
+    write_name_index(
+        _path=args_dict["output"])
     print("\nProcessing complete.")
@@ -18,13 +18,10 @@ PARTICULAR PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
-from scipy.spatial.distance import pdist, squareform
-import plotly.figure_factory as ff
-import plotly.graph_objects as go
-import plotly.offline as py
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist, cdist, squareform
 from sklearn import preprocessing
+from substructure_enrich.midas_table import MidasTable
 import pandas as pd
 import numpy as np
 import os
@@ -33,38 +30,125 @@ import os
 ROW_INDEX = "metabolite"
 COL_INDEX = "query_protein"
 VALUE_INDEX = "log2_abundance_corrected"
+DUPLICATES = "last"
+DUPLICATE_POLICIES = ("last", "first", "mean", "raise")
+
+# Defaults match the plotly dendrograms the radial order was first built from
+METRIC = "euclidean"
+METHOD = "complete"
+LINKAGE_METHODS = (
+    "single", "complete", "average", "weighted", "centroid", "median", "ward")
+EUCLIDEAN_METHODS = ("centroid", "median", "ward")
+
+RADIAL_ORDER = "radial_order.txt"
+RADIAL_CACHE = "radial_order.npz"
+
+# Metrics that are a per-protein sum, so added or removed proteins can be
+# folded into existing distances: summed metric and its transform to/from
+# the distance
+ADDITIVE_METRICS = {
+    "euclidean": ("sqeuclidean", np.square, np.sqrt),
+    "sqeuclidean": ("sqeuclidean", None, None),
+    "cityblock": ("cityblock", None, None),
+}
+
+# Recluster from scratch once this share of metabolites is new or changed
+REBUILD_FRACTION = 0.5
 
 
 """Functions
 """
 def import_table(
         database_url):
-    """Import URL as tab-delimited table
+    """Import URL as an integer-coded MIDAS table
     """
 
-    db = pd.read_csv(
-        database_url,
-        sep="\t",
-        index_col=False,
-        header=0
-    )
+    return MidasTable.read(database_url)
+
+
+def first_appearance(
+        codes,
+        labels):
+    """Recode integer codes so labels are numbered in order of first use
+
+    Codes below zero (missing labels) stay -1. Returns the new codes and the
+    labels in their new order.
+    """
+    valid = codes >= 0
+    used, first = np.unique(codes[valid], return_index=True)
+    order = used[np.argsort(first, kind='stable')]
 
-    return db
+    recode = np.full(len(labels), -1, dtype=np.int64)
+    recode[order] = np.arange(len(order))
+    return np.where(valid, recode[np.maximum(codes, 0)], -1), \
+        np.asarray(labels, dtype=object)[order]
 
 
 def unstack_table(
         data,
         row_index=ROW_INDEX,
         col_index=COL_INDEX,
-        value=VALUE_INDEX):
+        value=VALUE_INDEX,
+        duplicates=DUPLICATES):
     """Convert longform datatable to 2d array
-    """
 
-    unstacked_table = pd.DataFrame()
-    for index, row in data.iterrows():
-        unstacked_table.at[row[row_index], row[col_index]] = row[value]
+    `data` is a MidasTable or a long-form DataFrame. Values are written
+    straight into a preallocated float32 metabolite x protein matrix from
+    the integer codes of each row; pairs that never occur are NaN. Rows and
+    columns follow the order in which metabolites and proteins first appear,
+    and rows without a metabolite or protein name are skipped.
 
-    return unstacked_table
+    A metabolite/protein pair listed more than once keeps its `last` value
+    by default; `first`, `mean` or `raise` can be chosen instead.
+    """
+    if duplicates not in DUPLICATE_POLICIES:
+        raise Exception("Unknown duplicate handling:", duplicates)
+
+    if isinstance(data, MidasTable):
+        row_codes, row_labels = first_appearance(
+            data.metabolite_codes, data.metabolites)
+        col_codes, col_labels = first_appearance(
+            data.protein_codes, data.proteins)
+        values = data.stats[value]
+    else:
+        row_codes, row_labels = pd.factorize(data[row_index])
+        col_codes, col_labels = pd.factorize(data[col_index])
+        row_labels = np.asarray(row_labels, dtype=object)
+        col_labels = np.asarray(col_labels, dtype=object)
+        values = data[value].to_numpy(dtype=np.float32)
+
+    keep = (row_codes >= 0) & (col_codes >= 0)
+    cells = row_codes[keep].astype(np.int64) * len(col_labels) \
+        + col_codes[keep]
+    values = np.asarray(values, dtype=np.float32)[keep]
+    n_cells = len(row_labels) * len(col_labels)
+
+    unique_cells, first, counts = np.unique(
+        cells, return_index=True, return_counts=True)
+    n_duplicates = int((counts > 1).sum())
+    if n_duplicates > 0:
+        if duplicates == 'raise':
+            raise Exception(
+                "Metabolite/protein pairs listed more than once:", n_duplicates)
+        print(
+            n_duplicates, "metabolite/protein pairs listed more than once, keeping the",
+            duplicates, "value")
+
+    matrix = np.full(n_cells, np.nan, dtype=np.float32)
+    if duplicates == 'mean':
+        sums = np.bincount(cells, weights=values, minlength=n_cells)
+        n = np.bincount(cells, minlength=n_cells)
+        matrix[unique_cells] = sums[unique_cells] / n[unique_cells]
+    elif duplicates == 'first':
+        matrix[unique_cells] = values[first]
+    else:
+        _, last = np.unique(cells[::-1], return_index=True)
+        matrix[unique_cells] = values[len(cells) - 1 - last]
+
+    return pd.DataFrame(
+        matrix.reshape(len(row_labels), len(col_labels)),
+        index=pd.Index(row_labels, dtype=object),
+        columns=pd.Index(col_labels, dtype=object))
 
 
 def scale_metabolites(
@@ -79,43 +163,207 @@ def scale_metabolites(
     return data_scaled
 
 
-def trace_dendrograms(
-        midas_2d):
-
-    col_labels = midas_2d.columns.tolist()
-    fig = ff.create_dendrogram(
-        midas_2d.T,
-        orientation='bottom',
-        labels=col_labels)
-    for i in range(len(fig['data'])):
-        fig['data'][i]['yaxis'] = 'y2'
-
-    col_dendrogram = ff.create_dendrogram(
-        midas_2d.T,
-        orientation='bottom',
-        labels=col_labels)
-    for i in range(len(col_dendrogram['data'])):
-        col_dendrogram['data'][i]['yaxis'] = 'y2'
-
-    # Make metabolite dendrogram
-    row_labels = midas_2d.index.tolist()
-    row_dendrogram = ff.create_dendrogram(
-        midas_2d,
-        orientation='right',
-        labels=row_labels)
-    for i in range(len(row_dendrogram['data'])):
-        row_dendrogram['data'][i]['yaxis'] = 'y2'
+def check_clustering(
+        metric=METRIC,
+        method=METHOD):
+    """Raise if `method` cannot be used with `metric`
+    """
+    if method not in LINKAGE_METHODS:
+        raise Exception("Unknown linkage method:", method)
+    if method in EUCLIDEAN_METHODS and metric != "euclidean":
+        raise Exception("Linkage method requires the euclidean metric:", method)
+
+
+def cluster_linkage(
+        distances,
+        method=METHOD,
+        optimal_ordering=False):
+    """Return the `method` linkage of a condensed distance matrix
+
+    With `optimal_ordering` the leaves are reordered so that neighbouring
+    leaves are as similar as possible.
+    """
+    if len(distances) == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+    return hierarchy.linkage(
+        distances,
+        method=method,
+        optimal_ordering=optimal_ordering)
+
+
+def leaf_order(
+        linkage,
+        n_leaves):
+    """Return the dendrogram leaf order of a linkage
+    """
+    if n_leaves < 2:
+        return np.arange(n_leaves)
+    return hierarchy.leaves_list(linkage)
+
+
+def cluster_leaves(
+        matrix,
+        metric=METRIC,
+        method=METHOD,
+        optimal_ordering=False):
+    """Return the dendrogram leaf order of the rows of a 2d array
+
+    Rows are clustered by `method` linkage on their condensed `metric`
+    distances.
+    """
+    check_clustering(
+        metric=metric,
+        method=method)
+
+    matrix = np.asarray(matrix, dtype=np.float64)
+    linkage = cluster_linkage(
+        pdist(matrix, metric=metric),
+        method=method,
+        optimal_ordering=optimal_ordering)
+    return leaf_order(linkage, len(matrix))
+
 
-    # Add protein dendrogram data to figure object
-    for d in row_dendrogram['data']:
-        fig.add_trace(d)
+def load_radial_cache(
+        cache_file):
+    """Read the distances and linkage saved by a previous run, if any
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            return {k: data[k] for k in data.files}
+    except (OSError, ValueError):
+        print("Ignoring unreadable radial order cache:", cache_file)
+        return None
+
+
+def save_radial_cache(
+        cache_file,
+        midas_2d,
+        distances,
+        linkage,
+        metric,
+        method,
+        optimal_ordering):
+    """Store the matrix, distances and linkage next to the radial order
+    """
+    np.savez(
+        cache_file,
+        rows=np.array(list(map(str, midas_2d.index)), dtype=str),
+        columns=np.array(list(map(str, midas_2d.columns)), dtype=str),
+        matrix=midas_2d.to_numpy(dtype=np.float32),
+        distances=np.asarray(distances, dtype=np.float64),
+        linkage=np.asarray(linkage, dtype=np.float64),
+        metric=np.array(metric),
+        method=np.array(method),
+        optimal_ordering=np.bool_(optimal_ordering))
+
+
+def update_distances(
+        midas_2d,
+        cache=None,
+        metric=METRIC,
+        rebuild_fraction=REBUILD_FRACTION):
+    """Return condensed distances between metabolites, reusing a cached run
+
+    Metabolites (rows) that are new or have a changed value are the only
+    ones whose distances are recomputed; distances among the others are
+    copied from `cache`. Added or removed proteins (columns) are folded into
+    the copied distances for ADDITIVE_METRICS. Everything is recomputed if
+    there is no usable cache, the metric changed, proteins changed under a
+    non-additive metric, or more than `rebuild_fraction` of the metabolites
+    changed.
+
+    Returns the distances and the number of metabolites recomputed, which is
+    None after a full rebuild.
+    """
+    matrix = midas_2d.to_numpy(dtype=np.float64)
+    rows = list(map(str, midas_2d.index))
+    columns = list(map(str, midas_2d.columns))
+    n_rows = len(rows)
+
+    def rebuild():
+        return pdist(matrix, metric=metric), None
+
+    if cache is None or str(cache["metric"]) != metric:
+        return rebuild()
+
+    old_rows = {r: i for i, r in enumerate(cache["rows"].tolist())}
+    old_columns = {c: i for i, c in enumerate(cache["columns"].tolist())}
+    row_map = np.array([old_rows.get(r, -1) for r in rows], dtype=np.int64)
+    col_map = np.array([old_columns.get(c, -1) for c in columns], dtype=np.int64)
+    shared_cols = col_map >= 0
+    new_columns = set(columns)
+    removed_cols = np.array([
+        i for c, i in old_columns.items() if c not in new_columns],
+        dtype=np.int64)
+    columns_changed = (~shared_cols).any() or len(removed_cols) > 0
+    if columns_changed and metric not in ADDITIVE_METRICS:
+        return rebuild()
+
+    # New metabolites, and those with a changed value for a kept protein
+    old_matrix = cache["matrix"].astype(np.float64)
+    known = np.flatnonzero(row_map >= 0)
+    old_values = old_matrix[row_map[known]][:, col_map[shared_cols]]
+    new_values = matrix[known][:, shared_cols]
+    same = (old_values == new_values) \
+        | (np.isnan(old_values) & np.isnan(new_values))
+    dirty = np.ones(n_rows, dtype=bool)
+    dirty[known[same.all(axis=1)]] = False
+    if dirty.sum() > rebuild_fraction * n_rows:
+        return rebuild()
+
+    clean = np.flatnonzero(~dirty)
+    square = np.zeros((n_rows, n_rows), dtype=np.float64)
+    kept = squareform(cache["distances"])[
+        np.ix_(row_map[clean], row_map[clean])]
+
+    if columns_changed:
+        summed_metric, to_sum, from_sum = ADDITIVE_METRICS[metric]
+        if to_sum is not None:
+            kept = to_sum(kept)
+        if (~shared_cols).any():
+            kept += squareform(pdist(
+                matrix[clean][:, ~shared_cols], metric=summed_metric))
+        if len(removed_cols) > 0:
+            kept -= squareform(pdist(
+                old_matrix[row_map[clean]][:, removed_cols],
+                metric=summed_metric))
+        np.maximum(kept, 0, out=kept)
+        if from_sum is not None:
+            kept = from_sum(kept)
+    square[np.ix_(clean, clean)] = kept
+
+    changed = np.flatnonzero(dirty)
+    if len(changed) > 0:
+        block = cdist(matrix[changed], matrix, metric=metric)
+        square[changed, :] = block
+        square[:, changed] = block.T
+    np.fill_diagonal(square, 0)
+
+    return squareform(square, checks=False), len(changed)
 
-    # Create Heatmap traces
-    dendro_leaves_col = col_dendrogram['layout']['xaxis']['ticktext']
-    dendro_leaves_col = list(map(str, dendro_leaves_col))
 
-    dendro_leaves_row = row_dendrogram['layout']['yaxis']['ticktext']
-    dendro_leaves_row = list(map(str, dendro_leaves_row))
+def trace_dendrograms(
+        midas_2d,
+        metric=METRIC,
+        method=METHOD,
+        optimal_ordering=False):
+    """Return metabolite (row) and protein (column) labels in dendrogram order
+    """
+    row_leaves = cluster_leaves(
+        midas_2d.to_numpy(),
+        metric=metric,
+        method=method,
+        optimal_ordering=optimal_ordering)
+    col_leaves = cluster_leaves(
+        midas_2d.to_numpy().T,
+        metric=metric,
+        method=method,
+        optimal_ordering=optimal_ordering)
+
+    dendro_leaves_row = list(map(str, midas_2d.index[row_leaves]))
+    dendro_leaves_col = list(map(str, midas_2d.columns[col_leaves]))
 
     return dendro_leaves_row, dendro_leaves_col
 
@@ -144,24 +392,63 @@ def __main__(
     # Read database table and unstack
     midas_table = import_table(
         database_url=args_dict["database"])
-    midas_table_short = midas_table[[
-        ROW_INDEX,
-        COL_INDEX,
-        VALUE_INDEX
-    ]]
 
     midas_2d = unstack_table(
-        data=midas_table_short)
+        data=midas_table)
     print("MIDAS data summary:")
     print(midas_2d.describe())
 
-    # Make dendrograms
-    dendro_leaves_row, \
-    dendro_leaves_col = trace_dendrograms(
-        midas_2d=midas_2d)
+    # Order metabolites by hierarchical clustering, reusing the distances
+    # and linkage of the previous run where the data did not change
+    metric = args_dict.get("metric") or METRIC
+    method = args_dict.get("method") or METHOD
+    optimal_ordering = bool(args_dict.get("optimal_ordering"))
+    check_clustering(
+        metric=metric,
+        method=method)
+
+    cache_file = os.path.join(args_dict["output"], RADIAL_CACHE)
+    cache = None
+    if not args_dict.get("rebuild"):
+        cache = load_radial_cache(
+            cache_file=cache_file)
+
+    distances, \
+    n_updated = update_distances(
+        midas_2d=midas_2d,
+        cache=cache,
+        metric=metric)
+    if n_updated is None:
+        print("Computed distances for all", len(midas_2d), "metabolites")
+    else:
+        print("Recomputed distances for", n_updated, "of", len(midas_2d), "metabolites")
+
+    if cache is not None \
+            and str(cache["method"]) == method \
+            and bool(cache["optimal_ordering"]) == optimal_ordering \
+            and cache["rows"].tolist() == list(map(str, midas_2d.index)) \
+            and np.array_equal(cache["distances"], distances):
+        print("Distances unchanged, reusing linkage")
+        linkage = cache["linkage"]
+    else:
+        linkage = cluster_linkage(
+            distances,
+            method=method,
+            optimal_ordering=optimal_ordering)
+
+    dendro_leaves_row = list(map(
+        str, midas_2d.index[leaf_order(linkage, len(midas_2d))]))
 
     # Output reference file 
-    with open(os.path.join(args_dict["output"], "radial_order.txt"), "w") as fp:
+    with open(os.path.join(args_dict["output"], RADIAL_ORDER), "w") as fp:
         for x in dendro_leaves_row:
             fp.write(str(x) + "\n")
+    save_radial_cache(
+        cache_file=cache_file,
+        midas_2d=midas_2d,
+        distances=distances,
+        linkage=linkage,
+        metric=metric,
+        method=method,
+        optimal_ordering=optimal_ordering)
     print("\nProcessing complete.")
\ No newline at end of file
@@ -18,9 +18,16 @@ PARTICULAR PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from concurrent.futures import ProcessPoolExecutor
+import collections
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import itertools
+from urllib.parse import urlparse
+import shutil
+import mmap
+import csv
 import requests
 import zipfile
 import json
@@ -29,8 +36,20 @@ import io
 import re
 import os
 
+from substructure_enrich.hmdb import HMDBIndex
+from substructure_enrich.substructures import SubstructureTableWriter, SUBSTRUCTURE_TABLE
+from substructure_enrich.columnar import StringMapping, save_columns
+from substructure_enrich.names import write_name_index
+
+DOWNLOAD_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "electrum-utils")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
 SUBSTRUCTURE_DATA = "Substructures-DB-latest.txt"
 CHEMONTID_DICTIONARY = "CHEMONTID-mapper.json"
+CHEMONTID_TABLE = "CHEMONTID-mapper.npz"
+MISMATCH_REPORT = "CHEMONTID-mismatches.txt"
 
 ONT_URL = 'http://classyfire.wishartlab.com/system/downloads/1_0/chemont/ChemOnt_2_1.obo.zip'
 ONT_FILE = 'ChemOnt_2_1.obo'
@@ -39,6 +58,12 @@ ONT_DELIMITER = '[Term]'
 SDF_URL = 'https://hmdb.ca/system/downloads/current/structures.zip'
 SDF_FILE = 'structures.sdf'
 SDF_DELIMITER = '$$$$'
+SDF_TAG_PATTERN = re.compile(r'>[^<]*<([^>]+)>')
+SHARDS_PER_WORKER = 4
+# Shards are at most this many bytes and at most this many per worker are
+# parsed or waiting to be written at once, which bounds parent memory
+SHARD_SIZE = 64 * 1024 * 1024
+SHARDS_IN_FLIGHT = 2
 ENCODING = 'utf-8'
 CLASSYFIRE_HMDB_URL = 'http://classyfire.wishartlab.com/system/downloads/1_0/datasets/HMDB_36_classyfire_21_annotations.csv.zip'
 CLASSYFIRE_HMDB_FILE = 'HMDB_36_classyfire_21_annotations.csv'
@@ -55,6 +80,15 @@ NAME_KEY = 'GENERIC_NAME'
 SYNONYMS_KEY = 'SYNONYMS'
 SYNONYM_DELIMITER = ';'
 
+OUTPUT_COLUMNS = (
+    'hmdb_id',
+    'iupac_id',
+    'common_name',
+    'smiles',
+    'synonyms',
+    'taxonomy_ids',
+    'taxonomy_terms')
+
 CLASSYFIER_ID_COLUMN = 0
 CLASSYFIER_ONT_COLUMN = 1
 CLASSYFIER_CLASS_COLUMN = 2
@@ -63,70 +97,328 @@ CLASSYFIER_CLASS_COLUMN = 2
 """Classes
 """
 class Metabolite:
+    """Fields of one HMDB SDF record plus its ClassyFire annotations
+    """
+    __slots__ = OUTPUT_COLUMNS
+
     def __init__(
             self,
             record):
-        self.sdf_record = record
-        self.hmdb_id = self.lookup_sdf_info(HMDB_KEY)
-        self.iupac_id = self.lookup_sdf_info(IUPAC_KEY)
-        self.common_name = self.lookup_sdf_info(NAME_KEY)
-        self.smiles = self.lookup_sdf_info(SMILES_KEY)
-        self.synonyms = self.lookup_sdf_info(SYNONYMS_KEY)
+        fields = parse_sdf_fields(record)
+        self.hmdb_id = self.clean_sdf_info(fields.get(HMDB_KEY))
+        self.iupac_id = self.clean_sdf_info(fields.get(IUPAC_KEY))
+        self.common_name = self.clean_sdf_info(fields.get(NAME_KEY))
+        self.smiles = self.clean_sdf_info(fields.get(SMILES_KEY))
+        self.synonyms = self.clean_sdf_info(fields.get(SYNONYMS_KEY))
         self.taxonomy_ids = []
         self.taxonomy_terms = []
 
-        del self.sdf_record
-
-    def lookup_sdf_info(
-            self,
-            _key,
+    @staticmethod
+    def clean_sdf_info(
+            contents,
             _delimiter=SYNONYM_DELIMITER):
+        """Strip whitespace from a field value and split delimited lists
         """
-        """
+        if contents is None:
+            return None
 
-        for index in range(len(self.sdf_record)):
-            if _key in self.sdf_record[index]:
-                contents = self.sdf_record[index + 1] \
-                    .replace('\n', '') \
-                    .replace(' ', '')
-                if _delimiter in contents:
-                    contents = contents.split(_delimiter)
-                return contents
+        contents = contents \
+            .replace('\n', '') \
+            .replace(' ', '')
+        if _delimiter in contents:
+            contents = contents.split(_delimiter)
+        return contents
 
 
 """Functions
 """
-def download_zip_archive(
-        output,
+def read_validators(
+        _file):
+    """Return the stored ETag/Last-Modified for a downloaded file
+    """
+    try:
+        with open(_file + ".json") as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_validators(
+        _file,
+        validators):
+    with open(_file + ".json", "w") as json_file:
+        json.dump(validators, json_file)
+
+
+def fetch_archive(
         zip_url,
+        cache_path,
+        mirror_path=None,
+        chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Return a local copy of a zip archive, downloading it only if changed
+
+    Archives are kept in `cache_path` with their ETag/Last-Modified headers,
+    revalidated with a conditional request on each run and streamed to disk
+    when they have changed. An interrupted download is resumed on the next
+    run if the server supports range requests. If the server cannot be
+    reached, the cached copy is used.
+
+    With `mirror_path`, archives are taken from that directory (named as in
+    the download URL) and the network is not used.
+    """
+    file_name = os.path.basename(urlparse(zip_url).path)
+    if mirror_path is not None:
+        mirror_file = os.path.join(mirror_path, file_name)
+        if not os.path.isfile(mirror_file):
+            raise Exception("Provided mirror location is missing archive:", mirror_file)
+        return mirror_file
+
+    os.makedirs(cache_path, exist_ok=True)
+    archive_file = os.path.join(cache_path, file_name)
+    part_file = archive_file + ".part"
+
+    headers = {}
+    if os.path.isfile(archive_file):
+        cached = read_validators(archive_file)
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    partial = read_validators(part_file) if os.path.isfile(part_file) else {}
+    if_range = partial.get("etag") or partial.get("last_modified")
+    if if_range:
+        headers["Range"] = "bytes=%d-" % os.path.getsize(part_file)
+        headers["If-Range"] = if_range
+
+    try:
+        response = requests.get(
+            zip_url,
+            headers=headers,
+            stream=True,
+            timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        response = None
+
+    if response is None or (not response.ok and response.status_code != 304):
+        if response is not None:
+            response.close()
+        if os.path.isfile(archive_file):
+            print("Unable to reach " + zip_url + ", using cached " + archive_file)
+            return archive_file
+        raise Exception("Unable to download file at: " + zip_url)
+
+    with response:
+        if response.status_code == 304:
+            print("Using cached " + archive_file)
+            return archive_file
+
+        print("Downloading " + zip_url + "...")
+        write_validators(part_file, {
+            "url": zip_url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        })
+        mode = "ab" if response.status_code == 206 else "wb"
+        try:
+            with open(part_file, mode) as _f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    _f.write(chunk)
+        except requests.RequestException:
+            raise Exception("Download interrupted, run again to resume: " + zip_url)
+
+    os.replace(part_file + ".json", archive_file + ".json")
+    os.replace(part_file, archive_file)
+    return archive_file
+
+
+def find_archive_member(
+        archive,
         file_name):
-    """ Download HMDB SDF file containing all database SDF records
+    """Return the name of the member matching `file_name` in a ZipFile
+    """
+    for name in archive.namelist():
+        if name == file_name or os.path.basename(name) == file_name:
+            return name
+    raise Exception("Unable to find " + file_name + " in archive: " + str(archive.filename))
+
+
+def open_archive_member(
+        zip_file,
+        file_name,
+        _encoding=ENCODING):
+    """Open one member of a zip archive as text, without extracting it
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        member = archive.open(find_archive_member(archive, file_name))
+    return io.TextIOWrapper(member, encoding=_encoding)
+
+
+def extract_archive_member(
+        zip_file,
+        file_name,
+        output):
+    """Extract one member of a zip archive, skipping it if already up to date
     """
     output_file = os.path.join(output, file_name)
-    this_url = requests.get(zip_url)
-    if this_url.ok:
-        print("Unzipping HMDB metabolite SDF reference...")
-        this_zip = zipfile.ZipFile(io.BytesIO(this_url.content))
-        this_zip.extractall(output)
-        this_zip = None
-    else:
-        raise Exception("Unable to download file at: " + zip_url)
+    with zipfile.ZipFile(zip_file) as archive:
+        info = archive.getinfo(find_archive_member(archive, file_name))
+        if os.path.isfile(output_file) \
+                and os.path.getsize(output_file) == info.file_size \
+                and os.path.getmtime(output_file) >= os.path.getmtime(zip_file):
+            return output_file
+
+        print("Unzipping " + file_name + "...")
+        os.makedirs(output, exist_ok=True)
+        temp_file = output_file + ".part"
+        with archive.open(info) as member, open(temp_file, "wb") as _f:
+            shutil.copyfileobj(member, _f, DOWNLOAD_CHUNK_SIZE)
+        os.replace(temp_file, output_file)
+
     return output_file
 
 
-def parse_records_as_list(
+def iter_sdf_records(
         sdf_file,
         _delimiter=SDF_DELIMITER,
         _encoding=ENCODING):
+    """Yield the lines of each SDF record, one record at a time
     """
-    """
-    output_records = []
     with open(sdf_file, "r", encoding=_encoding) as _f:
-        for key, group in itertools.groupby(_f, lambda _l: _delimiter in _l):
-            if not key:
-                group = [x for x in list(group) if x != '\n']
-                output_records.append(group)
-    return output_records
+        yield from split_sdf_records(_f, _delimiter)
+
+
+def split_sdf_records(
+        lines,
+        _delimiter=SDF_DELIMITER):
+    """Group lines into SDF records, dropping blank lines
+    """
+    for key, group in itertools.groupby(lines, lambda _l: _delimiter in _l):
+        if not key:
+            yield [x for x in group if x != '\n']
+
+
+def shard_sdf(
+        sdf_file,
+        n_shards,
+        _delimiter=SDF_DELIMITER):
+    """Split an SDF file into byte ranges that end on record boundaries
+
+    Returns a list of (start, end) offsets covering the whole file
+    """
+    delimiter = _delimiter.encode(ENCODING)
+    with open(sdf_file, "rb") as _f:
+        size = os.fstat(_f.fileno()).st_size
+        if size == 0:
+            return []
+
+        with mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            shards = []
+            start = 0
+            for i in range(1, n_shards + 1):
+                if i == n_shards:
+                    end = size
+                else:
+                    end = mm.find(delimiter, max(start, size * i // n_shards))
+                    if end == -1:
+                        end = size
+                    else:
+                        end = mm.find(b'\n', end)
+                        end = size if end == -1 else end + 1
+                if end > start:
+                    shards.append((start, end))
+                    start = end
+                if start >= size:
+                    break
+
+    return shards
+
+
+# Annotation references for shard workers, set once per process
+_shard_references = {}
+
+
+def init_shard_worker(
+        hmdb_index,
+        ontology_dictionary):
+    _shard_references["hmdb_index"] = hmdb_index
+    _shard_references["ontology_dictionary"] = ontology_dictionary
+
+
+def parse_sdf_shard(
+        sdf_file,
+        start,
+        end,
+        _encoding=ENCODING):
+    """Parse and annotate the SDF records in one byte range of the file
+    """
+    with open(sdf_file, "rb") as _f:
+        with mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            contents = mm[start:end].decode(_encoding)
+
+    # Read lines with the same newline handling as the text-mode reader
+    return list(retrieve_substructures(
+        records=parse_metadata_from_records(
+            records=split_sdf_records(
+                io.StringIO(contents, newline=None))),
+        hmdb_index=_shard_references["hmdb_index"],
+        chebi_dictionary=None,
+        ontology_dictionary=_shard_references["ontology_dictionary"]))
+
+
+def parse_sdf_parallel(
+        sdf_file,
+        hmdb_index,
+        ontology_dictionary,
+        workers):
+    """Yield annotated Metabolites parsed by a pool of worker processes
+
+    The SDF is split into byte-range shards at `$$$$` boundaries. Records
+    are yielded in file order, so the output matches a single-process run.
+    Shards are at most about SHARD_SIZE bytes and only `workers *
+    SHARDS_IN_FLIGHT` are submitted or awaiting output at once, so memory
+    stays bounded however large the file is.
+    """
+    shards = shard_sdf(
+        sdf_file=sdf_file,
+        n_shards=max(
+            workers * SHARDS_PER_WORKER,
+            -(-os.path.getsize(sdf_file) // SHARD_SIZE)))
+
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_shard_worker,
+            initargs=(hmdb_index, ontology_dictionary)) as executor:
+        pending = collections.deque()
+        for start, end in shards:
+            if len(pending) >= workers * SHARDS_IN_FLIGHT:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(
+                parse_sdf_shard,
+                sdf_file,
+                start,
+                end))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def parse_sdf_fields(
+        record,
+        _pattern=SDF_TAG_PATTERN):
+    """Map each `> <TAG>` header in an SDF record to the line that follows it
+
+    The record is scanned once; the first occurrence of a tag wins
+    """
+    fields = {}
+    tag = None
+    for line in record:
+        if line.startswith('>'):
+            match = _pattern.match(line)
+            tag = match.group(1) if match is not None else None
+        elif tag is not None:
+            fields.setdefault(tag, line)
+            tag = None
+    return fields
 
 
 def parse_records_as_datatable(
@@ -146,141 +438,155 @@ def dict_from_datatable(
         input_source,
         id_col=CLASSYFIER_ID_COLUMN,
         ont_col=CLASSYFIER_ONT_COLUMN):
+    """Map each compound ID to its list of ChemOnt IDs, in file order
+
+    Rows are grouped by a stable sort on the factorized compound IDs and
+    split at the group boundaries, which is much faster than building the
+    lists row by row or with groupby().agg(list)
     """
-    """
-    table_dict = {}
-    for index, row in input_source.iterrows():
-        if row[id_col] in table_dict:
-            table_dict[row[id_col]].append(row[CLASSYFIER_ONT_COLUMN])
-        else:
-            table_dict[row[id_col]] = [row[CLASSYFIER_ONT_COLUMN]]
-    return table_dict
+    codes, ids = pd.factorize(input_source.iloc[:, id_col])
+    onts = input_source.iloc[:, ont_col].to_numpy(dtype=object)[codes >= 0]
+    codes = codes[codes >= 0]
+
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    return dict(zip(
+        ids,
+        (group.tolist() for group in np.split(onts[order], bounds))))
 
 
 def make_ontology_dictionary(
         hmdb_source,
         chebi_source,
         ont_col=CLASSYFIER_ONT_COLUMN,
-        name_col=CLASSYFIER_CLASS_COLUMN):
-    """
+        name_col=CLASSYFIER_CLASS_COLUMN,
+        report_file=None):
+    """Map each ChemOnt ID to its class name
+
+    ChEBI annotations take priority over HMDB, and the first name seen for
+    an ID is kept. IDs listed with other names are summarized, one line per
+    conflicting name, in `report_file` if given.
     """
+    table = pd.concat([
+        pd.DataFrame({
+            "ont": source.iloc[:, ont_col].to_numpy(),
+            "name": source.iloc[:, name_col].to_numpy()})
+        for source in (chebi_source, hmdb_source)
+    ], ignore_index=True)
+
+    first_names = table.drop_duplicates("ont", keep="first")
+    ontology_dictionary = dict(zip(first_names["ont"], first_names["name"]))
+
+    kept_names = table["ont"].map(ontology_dictionary)
+    mismatches = table.assign(kept_name=kept_names) \
+        .loc[table["name"].ne(kept_names)]
+
+    if len(mismatches) > 0:
+        mismatches = mismatches \
+            .groupby(["ont", "kept_name", "name"], sort=True, dropna=False) \
+            .size() \
+            .reset_index(name="rows")
+        print(
+            'Found ' + str(mismatches["ont"].nunique())
+            + ' IDs with mismatched names'
+            + (', see ' + report_file if report_file is not None else ''))
+        if report_file is not None:
+            mismatches.rename(columns={
+                "ont": "ChemOntID",
+                "kept_name": "Name",
+                "name": "Mismatched_name"
+            }).to_csv(report_file, sep='\t', index=False)
 
-    def add_ontology(
-            ont_dict,
-            data_source,
-            ont_col,
-            name_col):
-        for index, row in data_source.iterrows():
-            if row[ont_col] in ontology_dictionary:
-                if ont_dict[row[ont_col]] != row[name_col]:
-                    print(
-                        'Mismatched ID & Name for: '
-                        + str(row[ont_col])
-                        + '\n- ' + str(ont_dict[row[ont_col]])
-                        + '\n- ' + str(row[name_col])
-                        + '\n')
-            else:
-                ont_dict[row[ont_col]] = row[name_col]
-        return ont_dict
-
-    ontology_dictionary = {}
-    ontology_dictionary = add_ontology(
-        ontology_dictionary,
-        chebi_source,
-        ont_col,
-        name_col)
-    ontology_dictionary = add_ontology(
-        ontology_dictionary,
-        hmdb_source,
-        ont_col,
-        name_col)
     print('Found ' + str(len(ontology_dictionary.keys())) + ' terms')
     return ontology_dictionary
 
 
 def parse_metadata_from_records(
         records):
+    """Yield a Metabolite for each SDF record
     """
-    """
-    output_metadata = []
     for r in records:
-        thisSDF = Metabolite(record=r)
-        output_metadata.append(thisSDF)
-    return output_metadata
+        yield Metabolite(record=r)
 
 
 def retrieve_substructures(
         records,
-        hmdb_dictionary,
+        hmdb_index,
         chebi_dictionary,
         ontology_dictionary):
+    """Yield each Metabolite with its ClassyFire IDs and terms added
+
+    `hmdb_index` is the HMDBIndex of the ClassyFire HMDB records, so old
+    5-digit and current 7-digit IDs match in a single lookup
     """
-    """
-    for r in range(len(records)):
-        base_id = records[r].hmdb_id \
-            .replace('HMDB', '') \
-            .lstrip('0')
-        for x in range(12):
-            this_id = ('HMDB' + base_id.zfill(x + 1))
-            if this_id in hmdb_dictionary:
-                records[r].taxonomy_ids = hmdb_dictionary[this_id]
-                for t in records[r].taxonomy_ids:
-                    if t in ontology_dictionary:
-                        records[r].taxonomy_terms \
-                            .append(ontology_dictionary[t])
-                break
-    return records
+    for record in records:
+        taxonomy_ids = hmdb_index.get(record.hmdb_id)
+        if taxonomy_ids is not None:
+            record.taxonomy_ids = taxonomy_ids
+            for t in record.taxonomy_ids:
+                if t in ontology_dictionary:
+                    record.taxonomy_terms \
+                        .append(ontology_dictionary[t])
+        yield record
 
 
 def write_output(
         output_database,
         output_location,
-        synonym_key='synonyms',
-        tax_id_key='taxonomy_ids',
-        tax_term_key='taxonomy_terms'):
-    """
+        output_name=SUBSTRUCTURE_DATA,
+        dictionary_name=SUBSTRUCTURE_TABLE,
+        columns=OUTPUT_COLUMNS):
+    """Write the substructure table and its columnar HMDB reference
+
+    Records are consumed one at a time and streamed into the tab-delimited
+    table; only the columns used for enrichment (hmdb_id, taxonomy_ids and
+    taxonomy_terms) are kept for the SubstructureTable, which is written
+    once all records are read. List fields are joined with `;`.
+    Returns the number of records written.
     """
     def try_join(
             l,
             sep=';'):
+        if l is None:
+            return ''
+        if isinstance(l, str):
+            return l
         try:
             return str(sep).join(map(str, l))
         except TypeError:
             return ''
 
-    mod_output = [d.__dict__ for d in output_database]
-    output_table = pd.DataFrame(mod_output)
-    output_table[synonym_key] = [
-        try_join(l) for l in output_table[synonym_key]]
-    output_table[tax_id_key] = [
-        try_join(l) for l in output_table[tax_id_key]]
-    output_table[tax_term_key] = [
-        try_join(l) for l in output_table[tax_term_key]]
-    output_table.to_csv(
-        os.path.join(
-            str(output_location), SUBSTRUCTURE_DATA),
-        sep='\t')
+    count = 0
+    substructure_table = SubstructureTableWriter()
+    with open(os.path.join(str(output_location), output_name), 'w', newline='') as table_file:
+        writer = csv.writer(table_file, delimiter='\t', lineterminator='\n')
+        writer.writerow([''] + list(columns))
+
+        for record in output_database:
+            row = [try_join(getattr(record, c)) for c in columns]
+            writer.writerow([count] + row)
+            substructure_table.append(dict(zip(columns, row)))
+            count += 1
+
+    substructure_table.save(
+        os.path.join(str(output_location), dictionary_name))
+
+    return count
 
 
 def write_dictionary(
         output_dictionary,
         output_location,
-        output_name=CHEMONTID_DICTIONARY):
-    """
+        output_name=CHEMONTID_DICTIONARY,
+        table_name=None):
+    """Write a dictionary as JSON and, with `table_name`, as a mapped table
     """
     with open(os.path.join(output_location, output_name), 'w') as fp:
         json.dump(output_dictionary, fp)
-
-
-def clean_downloads(
-        output_files):
-    """
-    """
-    for o in output_files:
-        try:
-            os.remove(o)
-        except:
-            print('Unable to remove file ' + o)
+    if table_name is not None:
+        save_columns(
+            os.path.join(output_location, table_name),
+            StringMapping.compile(output_dictionary))
 
 
 def import_table(
@@ -313,14 +619,19 @@ def parse_ont_as_list(
         ont_file,
         _delimiter=ONT_DELIMITER,
         _encoding=ENCODING):
+    """Group ChemOnt OBO lines into [Term] records
+
+    `ont_file` may be a path or an open text file
     """
-    """
+    if not hasattr(ont_file, 'read'):
+        with open(ont_file, "r", encoding=_encoding) as _f:
+            return parse_ont_as_list(_f, _delimiter, _encoding)
+
     output_records = []
-    with open(ont_file, "r", encoding=_encoding) as _f:
-        for key, group in itertools.groupby(_f, lambda _l: _delimiter in _l):
-            if not key:
-                group = [x for x in list(group) if x != '\n']
-                output_records.append(group)
+    for key, group in itertools.groupby(ont_file, lambda _l: _delimiter in _l):
+        if not key:
+            group = [x for x in list(group) if x != '\n']
+            output_records.append(group)
     return output_records
 
 def parse_dict_from_records(
@@ -351,91 +662,101 @@ def parse_dict_from_records(
     return ont_dict
 
 def __main__(args_dict):
+    """Build the substructure, CHEMONTID and hierarchy reference files
+
+    Source archives are cached under `--cache` (default: DOWNLOAD_CACHE) and
+    only downloaded again when they change on the server; with `--mirror`
+    they are read from a local directory instead
     """
-    """
+    if args_dict.get("mirror") and not os.path.isdir(args_dict["mirror"]):
+        raise Exception("Provided mirror location cannot be found:", args_dict["mirror"])
+
+    cache_path = args_dict.get("cache") or DOWNLOAD_CACHE
+    mirror_path = args_dict.get("mirror") or None
 
-    # Parse all HMDB SDF records
-    sdf_file = download_zip_archive(
-        output=args_dict["output"],
+    # Download HMDB SDF records
+    sdf_archive = fetch_archive(
         zip_url=SDF_URL,
-        file_name=SDF_FILE)
-    record_list = parse_records_as_list(
-        sdf_file=sdf_file)
-    output_metadata = parse_metadata_from_records(
-        records=record_list)
+        cache_path=cache_path,
+        mirror_path=mirror_path)
 
     # Parse ClassyFire HMDB records
-    cf_hmdb_file = download_zip_archive(
-        output=args_dict["output"],
+    cf_hmdb_archive = fetch_archive(
         zip_url=CLASSYFIRE_HMDB_URL,
-        file_name=CLASSYFIRE_HMDB_FILE)
-    hmdb_records = parse_records_as_datatable(
-        input_file=cf_hmdb_file)
-    hmdb_dictionary = dict_from_datatable(
-        input_source=hmdb_records)
+        cache_path=cache_path,
+        mirror_path=mirror_path)
+    with open_archive_member(cf_hmdb_archive, CLASSYFIRE_HMDB_FILE) as cf_hmdb_file:
+        hmdb_records = parse_records_as_datatable(
+            input_file=cf_hmdb_file)
+    hmdb_index = HMDBIndex(dict_from_datatable(
+        input_source=hmdb_records))
 
     # Parse ClassyFire CHEBI records
-    cf_chebi_file = download_zip_archive(
-        output=args_dict["output"],
+    cf_chebi_archive = fetch_archive(
         zip_url=CLASSYFIRE_CHEBI_URL,
-        file_name=CLASSYFIRE_CHEBI_FILE)
-    chebi_records = parse_records_as_datatable(
-        input_file=cf_chebi_file)
+        cache_path=cache_path,
+        mirror_path=mirror_path)
+    with open_archive_member(cf_chebi_archive, CLASSYFIRE_CHEBI_FILE) as cf_chebi_file:
+        chebi_records = parse_records_as_datatable(
+            input_file=cf_chebi_file)
     chebi_dictionary = dict_from_datatable(
         input_source=chebi_records)
 
     # Make ontology reference
     ontology_dictionary = make_ontology_dictionary(
         hmdb_source=hmdb_records,
-        chebi_source=chebi_records)
+        chebi_source=chebi_records,
+        report_file=os.path.join(args_dict["output"], MISMATCH_REPORT))
 
     write_dictionary(
         output_dictionary=ontology_dictionary,
-        output_location=args_dict["output"])
-
-    # Add ontology IDs and terms to each SDF record
-    output_substructures = retrieve_substructures(
-        records=output_metadata,
-        hmdb_dictionary=hmdb_dictionary,
-        chebi_dictionary=chebi_dictionary,
-        ontology_dictionary=ontology_dictionary)
-
-    # Output and clean
-    write_output(
-        output_database=output_substructures,
-        output_location=args_dict["output"])
-
-    # Import parsed ClassyFire sub-structure database
-    substructure_table = import_table(
-        _path=args_dict["output"],
-        _file=SUBSTRUCTURE_DATA,
-        index_col=0)
-    substructure_table.index = substructure_table['hmdb_id']
-    substructure_dictionary = substructure_table.T.to_dict()
-
-    write_dictionary(
-        output_dictionary=substructure_dictionary,
-        output_location=args_dict["output"], 
-        output_name="CHEMONTID-substructure-dictionary.json")
+        output_location=args_dict["output"],
+        table_name=CHEMONTID_TABLE)
+
+    # Stream SDF records through parsing and ClassyFire annotation into the
+    # substructure table and dictionary; no step holds every record.
+    # Sharded parsing memory-maps the SDF, so it is extracted to the cache
+    workers = int(args_dict.get("workers") or 1)
+    if workers > 1:
+        sdf_file = extract_archive_member(
+            zip_file=sdf_archive,
+            file_name=SDF_FILE,
+            output=cache_path)
+        record_count = write_output(
+            output_database=parse_sdf_parallel(
+                sdf_file=sdf_file,
+                hmdb_index=hmdb_index,
+                ontology_dictionary=ontology_dictionary,
+                workers=workers),
+            output_location=args_dict["output"])
+    else:
+        with open_archive_member(sdf_archive, SDF_FILE) as sdf_file:
+            record_count = write_output(
+                output_database=retrieve_substructures(
+                    records=parse_metadata_from_records(
+                        records=split_sdf_records(sdf_file)),
+                    hmdb_index=hmdb_index,
+                    chebi_dictionary=chebi_dictionary,
+                    ontology_dictionary=ontology_dictionary),
+                output_location=args_dict["output"])
+    print('Wrote ' + str(record_count) + ' substructure records')
+
+    # Refresh the metabolite name index with the new SDF synonyms
+    if os.path.isfile(os.path.join(args_dict["output"], "metabolites.json")):
+        write_name_index(
+            _path=args_dict["output"])
 
     # Generate CHEMONTID hierarchal structure reference 
-    ont_file = download_zip_archive(
-        output=args_dict["output"],
+    ont_archive = fetch_archive(
         zip_url=ONT_URL,
-        file_name=ONT_FILE)
-    ont_data = parse_ont_as_list(
-        ont_file=ont_file)
+        cache_path=cache_path,
+        mirror_path=mirror_path)
+    with open_archive_member(ont_archive, ONT_FILE) as ont_file:
+        ont_data = parse_ont_as_list(
+            ont_file=ont_file)
     ont_dict = parse_dict_from_records(
         ont_data=ont_data)
     write_dictionary(
         output_dictionary=ont_dict,
         output_location=args_dict["output"],
         output_name='CHEMONTID-hierarchy-dictionary.json')
-
-    clean_downloads(
-        output_files=[
-            sdf_file,
-            cf_hmdb_file,
-            cf_chebi_file,
-            ont_file])
-
@@ -0,0 +1,331 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+from collections.abc import Mapping
+from array import array
+from bisect import bisect_left
+import numpy as np
+import zipfile
+import os
+
+ENCODING = 'utf-8'
+LOCAL_HEADER_SIZE = 30
+
+
+"""Functions
+"""
+def save_columns(
+        output_file,
+        arrays):
+    """Write arrays as an uncompressed NumPy archive
+
+    Members are stored rather than deflated so `ColumnFile` can map them.
+    The file is replaced atomically, so processes that have the previous
+    version mapped keep reading it until they reload.
+    """
+    temp_file = output_file + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_file, 'wb') as _f:
+        np.savez(_f, **arrays)
+    os.replace(temp_file, output_file)
+    return output_file
+
+
+"""Classes
+"""
+class ColumnFile:
+    """Read-only view of the arrays in a `save_columns` archive
+
+    Each array is memory-mapped the first time it is requested; arrays that
+    are never used are never read. Mapped pages live in the OS page cache,
+    so processes that open the same file share them.
+    """
+    def __init__(
+            self,
+            file_path):
+        self.file_path = file_path
+        self._arrays = {}
+        with zipfile.ZipFile(file_path) as archive:
+            self._members = {
+                info.filename[:-len('.npy')]: info
+                for info in archive.infolist()
+                if info.filename.endswith('.npy')}
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file):
+        return cls(os.path.join(_path, _file))
+
+    @property
+    def files(self):
+        return list(self._members)
+
+    def __contains__(
+            self,
+            name):
+        return name in self._members
+
+    def __getitem__(
+            self,
+            name):
+        if name not in self._arrays:
+            self._arrays[name] = self._map(self._members[name])
+        return self._arrays[name]
+
+    def _map(
+            self,
+            info):
+        """Map one stored member, or read it if it was compressed
+        """
+        with open(self.file_path, 'rb') as _f:
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zipfile.ZipFile(_f) as archive, archive.open(info) as member:
+                    return np.lib.format.read_array(member, allow_pickle=False)
+
+            # Skip the local file header to reach the .npy header
+            _f.seek(info.header_offset)
+            header = _f.read(LOCAL_HEADER_SIZE)
+            name_length = int.from_bytes(header[26:28], 'little')
+            extra_length = int.from_bytes(header[28:30], 'little')
+            _f.seek(info.header_offset + LOCAL_HEADER_SIZE
+                    + name_length + extra_length)
+
+            version = np.lib.format.read_magic(_f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_1_0(_f)
+            else:
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_2_0(_f)
+            offset = _f.tell()
+
+        if dtype.hasobject:
+            raise ValueError("Object arrays cannot be memory-mapped")
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        # A plain ndarray view of the map; indexing np.memmap itself is
+        # several times slower for the scalar lookups done per query
+        return np.memmap(
+            self.file_path,
+            dtype=dtype,
+            mode='r',
+            offset=offset,
+            shape=shape,
+            order='F' if fortran_order else 'C').view(np.ndarray)
+
+
+class StringTable:
+    """Strings stored as one UTF-8 byte buffer plus integer offsets
+
+    String i is `data[offsets[i]:offsets[i + 1]]`. Both arrays can be
+    memory-mapped, so a table is decoded only where it is read.
+    """
+    def __init__(
+            self,
+            data,
+            offsets):
+        self.data = data
+        self.offsets = offsets
+
+        # Buffer views give Python ints and bytes without numpy scalar
+        # overhead, which dominates single-string lookups
+        self._data = memoryview(
+            np.ascontiguousarray(data, dtype=np.uint8)).cast('B')
+        self._offsets = memoryview(
+            np.ascontiguousarray(offsets, dtype=np.int64)).cast('B').cast('q')
+
+    @classmethod
+    def from_strings(
+            cls,
+            strings):
+        writer = StringTableWriter()
+        for s in strings:
+            writer.append(s)
+        return writer.table()
+
+    @classmethod
+    def from_columns(
+            cls,
+            columns,
+            name):
+        """Return the table stored under `name` by `arrays`
+        """
+        return cls(columns[name + '_data'], columns[name + '_offsets'])
+
+    def arrays(
+            self,
+            name):
+        return {
+            name + '_data': np.asarray(self.data),
+            name + '_offsets': np.asarray(self.offsets)}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(
+            self,
+            i):
+        return str(
+            self._data[self._offsets[i]:self._offsets[i + 1]], ENCODING)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """Return the encoded length of every string
+        """
+        return np.diff(self.offsets)
+
+
+class StringTableWriter:
+    """Build a StringTable one string at a time
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+
+    def append(
+            self,
+            s):
+        self.data += s.encode(ENCODING)
+        self.offsets.append(len(self.data))
+
+    def table(self):
+        return StringTable(
+            data=np.frombuffer(bytes(self.data), dtype=np.uint8),
+            offsets=np.frombuffer(self.offsets, dtype=np.int64).copy())
+
+
+class StringMapping(Mapping):
+    """Read-only str -> str mapping stored as sorted string tables
+
+    Keys are looked up by binary search over the mapped `keys` table, so
+    nothing is decoded up front and no per-process dictionary is built.
+    """
+    def __init__(
+            self,
+            columns):
+        self.columns = columns
+        self.keys_table = StringTable.from_columns(columns, 'keys')
+        self.values_table = StringTable.from_columns(columns, 'values')
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file):
+        return cls(ColumnFile.load(_path, _file))
+
+    @staticmethod
+    def compile(
+            mapping):
+        """Return the arrays of a `save_columns` file for `mapping`
+
+        Entries without a string value (missing names stored as NaN) are
+        left out
+        """
+        keys = sorted(k for k, v in mapping.items() if isinstance(v, str))
+        arrays = StringTable.from_strings(keys).arrays('keys')
+        arrays.update(StringTable.from_strings(
+            [mapping[k] for k in keys]).arrays('values'))
+        return arrays
+
+    def find(
+            self,
+            key):
+        """Return the position of `key`, or -1 if it is not present
+        """
+        if not isinstance(key, str):
+            return -1
+        i = bisect_left(self.keys_table, key)
+        if i < len(self.keys_table) and self.keys_table[i] == key:
+            return i
+        return -1
+
+    def value(
+            self,
+            i):
+        return self.values_table[i]
+
+    def __getitem__(
+            self,
+            key):
+        i = self.find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self.value(i)
+
+    def __contains__(
+            self,
+            key):
+        return self.find(key) != -1
+
+    def __iter__(self):
+        return iter(self.keys_table)
+
+    def __len__(self):
+        return len(self.keys_table)
+
+
+class RecordMapping(StringMapping):
+    """Read-only str -> record mapping, one string table per record field
+
+    Every record must have the same string-valued fields, as in
+    metabolites.json; lookups return a new dictionary of those fields.
+    """
+    def __init__(
+            self,
+            columns):
+        self.columns = columns
+        self.keys_table = StringTable.from_columns(columns, 'keys')
+        self.fields = list(StringTable.from_columns(columns, 'fields'))
+        self.field_tables = [
+            StringTable.from_columns(columns, 'field_' + f)
+            for f in self.fields]
+
+    @staticmethod
+    def compile(
+            mapping):
+        keys = sorted(mapping)
+        fields = list(mapping[keys[0]]) if len(keys) > 0 else []
+        for k in keys:
+            record = mapping[k]
+            if list(record) != fields \
+                    or not all(isinstance(v, str) for v in record.values()):
+                raise ValueError(
+                    "Records must share the same string fields:", k)
+
+        arrays = StringTable.from_strings(keys).arrays('keys')
+        arrays.update(StringTable.from_strings(fields).arrays('fields'))
+        for f in fields:
+            arrays.update(StringTable.from_strings(
+                [mapping[k][f] for k in keys]).arrays('field_' + f))
+        return arrays
+
+    def value(
+            self,
+            i):
+        return {f: t[i] for f, t in zip(self.fields, self.field_tables)}
@@ -0,0 +1,261 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+import pandas as pd
+import numpy as np
+import os
+
+from .midas_table import MidasTable, UNANNOTATED_TERM
+
+CONTINGENCY_TABLES = "MIDAS-contingency-tables.npz"
+
+
+"""Classes
+"""
+class ContingencyTables:
+    """Per-protein q-values and CHEMONTID incidence for a MIDAS dataset
+
+    For each protein the rows are stored sorted by q-value. Each CHEMONTID
+    seen for that protein keeps its total count (C) and the sorted q-value
+    ranks of the rows it appears in, so A, B, C and D for any threshold come
+    from one binary search over the q-values and one over the ranks.
+    `reference_hash` identifies the reference files the annotations came
+    from (ReferenceStore.annotation_hash); tables built from other
+    references are not used.
+
+    Arrays (proteins and CHEMONTIDs are stored once as string tables):
+        proteins        protein names
+        terms           CHEMONTIDs, with UNANNOTATED_TERM for missing annotations
+        row_indptr      per-protein offsets into q_values
+        q_values        q-values, ascending within each protein
+        observed_cum    unique metabolites among the first k rows, k = 0..n,
+                        per protein at offset row_indptr[p] + p
+        term_indptr     per-protein offsets into term_ids/term_totals
+        term_ids        index into terms, in order of first appearance
+        term_totals     C for each term
+        hit_indptr      per-protein offsets into hit_keys
+        hit_keys        local term index * (n + 1) + q-value rank, ascending
+    """
+    def __init__(
+            self,
+            arrays,
+            library_size,
+            dataset_id="",
+            hierarchy=False,
+            reference_hash=""):
+        self.arrays = arrays
+        self.library_size = int(library_size)
+        self.dataset_id = str(dataset_id)
+        self.hierarchy = bool(hierarchy)
+        self.reference_hash = str(reference_hash)
+        self.protein_index = {
+            p: i for i, p in enumerate(arrays["proteins"].tolist())}
+
+    def __contains__(
+            self,
+            protein):
+        return protein in self.protein_index
+
+    @property
+    def proteins(self):
+        return self.arrays["proteins"].tolist()
+
+    @classmethod
+    def from_table(
+            cls,
+            unified_table,
+            library_size,
+            dataset_id="",
+            proteins=None,
+            hierarchy=False,
+            reference_hash=""):
+        """Build tables from a cross-referenced MIDAS table
+
+        `unified_table` is an annotated MidasTable, or a DataFrame with
+        `query_protein`, `metabolite`, `q_value` and `taxonomy_ids` columns.
+        `library_size` is the number of unique metabolites in the whole
+        library. `hierarchy` records whether the taxonomy IDs were propagated
+        to their ancestors.
+        """
+        if not isinstance(unified_table, MidasTable):
+            unified_table = MidasTable.from_frame(unified_table)
+
+        protein_index = unified_table.protein_index
+        if proteins is None:
+            proteins = unified_table.proteins.tolist()
+        protein_codes = [
+            protein_index[p] for p in sorted(set(proteins))
+            if p in protein_index]
+        q_all = unified_table.stats['q_value']
+
+        protein_names = []
+        q_values = []
+        observed_cum = []
+        term_ids = []
+        term_totals = []
+        hit_keys = []
+        row_indptr = [0]
+        term_indptr = [0]
+        hit_indptr = [0]
+
+        for p in protein_codes:
+            rows = unified_table.rows(p)
+            n_rows = len(rows)
+            if n_rows == 0:
+                continue
+
+            # Rank rows by q-value; ties do not matter for `q < threshold`
+            q = q_all[rows].astype(np.float64)
+            order = np.argsort(q, kind='stable')
+            ranks = np.empty(n_rows, dtype=np.int64)
+            ranks[order] = np.arange(n_rows)
+
+            _, first = np.unique(
+                unified_table.metabolite_codes[rows][order],
+                return_index=True)
+            first_seen = np.zeros(n_rows, dtype=bool)
+            first_seen[first] = True
+            observed = np.zeros(n_rows + 1, dtype=np.int64)
+            observed[1:] = np.cumsum(first_seen)
+
+            # One entry per (row, CHEMONTID), in original row order
+            row_positions, row_terms = unified_table.row_terms(rows)
+            codes, local_terms = pd.factorize(row_terms)
+            codes = codes.astype(np.int64)
+
+            keys = np.sort(codes * (n_rows + 1) + ranks[row_positions])
+            totals = np.bincount(codes, minlength=len(local_terms))
+
+            protein_names.append(unified_table.proteins[p])
+            q_values.append(q[order])
+            observed_cum.append(observed)
+            term_ids.append(local_terms.astype(np.int64))
+            term_totals.append(totals.astype(np.int64))
+            hit_keys.append(keys)
+            row_indptr.append(row_indptr[-1] + n_rows)
+            term_indptr.append(term_indptr[-1] + len(local_terms))
+            hit_indptr.append(hit_indptr[-1] + len(keys))
+
+        def concat(parts, dtype):
+            if len(parts) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate(parts).astype(dtype, copy=False)
+
+        arrays = {
+            "proteins": np.array(protein_names, dtype=str),
+            "terms": np.array(unified_table.terms, dtype=str),
+            "row_indptr": np.array(row_indptr, dtype=np.int64),
+            "q_values": concat(q_values, np.float64),
+            "observed_cum": concat(observed_cum, np.int64),
+            "term_indptr": np.array(term_indptr, dtype=np.int64),
+            "term_ids": concat(term_ids, np.int64),
+            "term_totals": concat(term_totals, np.int64),
+            "hit_indptr": np.array(hit_indptr, dtype=np.int64),
+            "hit_keys": concat(hit_keys, np.int64),
+        }
+        return cls(
+            arrays=arrays,
+            library_size=library_size,
+            dataset_id=dataset_id,
+            hierarchy=hierarchy,
+            reference_hash=reference_hash)
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file=CONTINGENCY_TABLES):
+        """Load tables written by `save`
+        """
+        with np.load(os.path.join(_path, _file), allow_pickle=False) as data:
+            arrays = {k: data[k] for k in data.files}
+
+        library_size = arrays.pop("library_size")
+        dataset_id = arrays.pop("dataset_id")
+        hierarchy = arrays.pop("hierarchy", False)
+        reference_hash = arrays.pop("reference_hash", "")
+        return cls(
+            arrays=arrays,
+            library_size=library_size,
+            dataset_id=str(dataset_id),
+            hierarchy=bool(hierarchy),
+            reference_hash=str(reference_hash))
+
+    def save(
+            self,
+            _path,
+            _file=CONTINGENCY_TABLES):
+        """Write tables as a compressed NumPy archive
+        """
+        output_file = os.path.join(_path, _file)
+        np.savez_compressed(
+            output_file,
+            library_size=np.int64(self.library_size),
+            dataset_id=np.array(self.dataset_id),
+            hierarchy=np.bool_(self.hierarchy),
+            reference_hash=np.array(self.reference_hash),
+            **self.arrays)
+        return output_file
+
+    def counts(
+            self,
+            TARGET,
+            THRESHOLD):
+        """Return CHEMONTID, A, B, C and D for `TARGET` at a q-value threshold
+
+        Rows and columns match the counts built by `substructure_enrichment`
+        """
+        a = self.arrays
+        p = self.protein_index[TARGET]
+
+        row_start, row_end = a["row_indptr"][p], a["row_indptr"][p + 1]
+        n_rows = row_end - row_start
+        k = np.searchsorted(
+            a["q_values"][row_start:row_end], THRESHOLD, side='left')
+        observed_count = a["observed_cum"][row_start + p + k]
+
+        term_start, term_end = a["term_indptr"][p], a["term_indptr"][p + 1]
+        n_terms = term_end - term_start
+        keys = a["hit_keys"][a["hit_indptr"][p]:a["hit_indptr"][p + 1]]
+
+        # Number of hits per term with q-value rank below k
+        bounds = np.arange(n_terms + 1, dtype=np.int64) * (n_rows + 1)
+        below = np.searchsorted(keys, bounds[:-1] + k, side='left')
+        observed = below - np.searchsorted(keys, bounds[:-1], side='left')
+
+        expected = a["term_totals"][term_start:term_end]
+        chemontids = a["terms"][a["term_ids"][term_start:term_end]] \
+            .astype(object)
+        chemontids[chemontids == UNANNOTATED_TERM] = np.nan
+
+        results_table = pd.DataFrame({
+            "CHEMONTID": chemontids,
+            "A": observed,
+            "B": observed_count - observed,
+            "C": expected,
+            "D": self.library_size - expected
+        }, index=chemontids)
+        results_table.index.name = None
+
+        return results_table
@@ -0,0 +1,125 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+import numpy as np
+import json
+import os
+
+HIERARCHY_DICTIONARY = "CHEMONTID-hierarchy-dictionary.json"
+
+
+"""Classes
+"""
+class HierarchyClosure:
+    """Ancestor closure of the ChemOnt `is_a` hierarchy
+
+    CHEMONTIDs are integer-coded by their position in `terms`. The closure of
+    term i (itself, then its parent, grandparent, ...) is
+    `ancestor_ids[ancestor_indptr[i]:ancestor_indptr[i + 1]]`, computed once
+    when the hierarchy is loaded so no dictionary walks happen per request.
+    """
+    def __init__(
+            self,
+            hierarchy_dictionary):
+        self.terms = [k for k in hierarchy_dictionary if k != ""]
+        self.index = {t: i for i, t in enumerate(self.terms)}
+        self.names = {
+            t: hierarchy_dictionary[t]["name"] for t in self.terms}
+
+        parents = np.full(len(self.terms), -1, dtype=np.int32)
+        for t, i in self.index.items():
+            parent = hierarchy_dictionary[t].get("is_a", "")
+            if parent in self.index and parent != t:
+                parents[i] = self.index[parent]
+
+        ancestor_indptr = [0]
+        ancestor_ids = []
+        for i in range(len(self.terms)):
+            seen = set()
+            j = i
+            while j != -1 and j not in seen:
+                seen.add(j)
+                ancestor_ids.append(j)
+                j = parents[j]
+            ancestor_indptr.append(len(ancestor_ids))
+
+        self.parents = parents
+        self.ancestor_indptr = np.array(ancestor_indptr, dtype=np.int32)
+        self.ancestor_ids = np.array(ancestor_ids, dtype=np.int32)
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file=HIERARCHY_DICTIONARY):
+        """Build the closure from the hierarchy written by make_structure_dictionary
+        """
+        with open(os.path.join(_path, _file)) as json_file:
+            return cls(json.load(json_file))
+
+    def ancestors(
+            self,
+            term):
+        """Return `term` and all of its ancestors, nearest first
+        """
+        i = self.index.get(term)
+        if i is None:
+            return [term]
+        return [
+            self.terms[j] for j in self.ancestor_ids[
+                self.ancestor_indptr[i]:self.ancestor_indptr[i + 1]].tolist()]
+
+    def expand(
+            self,
+            taxonomy_ids,
+            _delimiter=';'):
+        """Add all ancestors to a delimited list of CHEMONTIDs
+
+        The original IDs keep their order and ancestors follow; each ID is
+        listed once. Missing annotations are returned unchanged.
+        """
+        if not isinstance(taxonomy_ids, str):
+            return taxonomy_ids
+
+        expanded = dict.fromkeys(taxonomy_ids.split(_delimiter))
+        for t in list(expanded):
+            for a in self.ancestors(t):
+                expanded[a] = None
+
+        return _delimiter.join(expanded)
+
+    def propagate(
+            self,
+            mapping,
+            _delimiter=';'):
+        """Propagate the taxonomy IDs in a `map_metabolites` table to ancestors
+        """
+        mapping = mapping.copy()
+        mapping['taxonomy_ids'] = [
+            self.expand(t, _delimiter) for t in mapping['taxonomy_ids']]
+        mapping['taxonomy_terms'] = [
+            _delimiter.join(self.names.get(i, i) for i in t.split(_delimiter))
+            if isinstance(t, str) else t
+            for t in mapping['taxonomy_ids']]
+        return mapping
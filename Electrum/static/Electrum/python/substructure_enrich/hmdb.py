@@ -0,0 +1,103 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+import json
+import re
+import os
+
+HMDB_PATTERN = re.compile(r'\s*HMDB0*(\d+)\s*$', re.IGNORECASE)
+HMDB_WIDTH = 7
+
+
+"""Functions
+"""
+def normalize_hmdb_id(
+        hmdb_id):
+    """Return the numeric part of an HMDB ID, or None if it is not one
+
+    Zero-padding and case are ignored, so `HMDB00001`, `HMDB0000001` and
+    `hmdb1` all normalize to 1
+    """
+    if not isinstance(hmdb_id, str):
+        return None
+    match = HMDB_PATTERN.match(hmdb_id)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def format_hmdb_id(
+        hmdb_number,
+        width=HMDB_WIDTH):
+    """Return the canonical (current HMDB, 7-digit) form of a numeric HMDB ID
+    """
+    return 'HMDB' + str(hmdb_number).zfill(width)
+
+
+"""Classes
+"""
+class HMDBIndex:
+    """Lookup table keyed by numeric HMDB ID
+
+    Built once from a dictionary keyed by HMDB ID strings in any padding;
+    lookups normalize the query and make a single integer-keyed probe. If
+    several keys share a number, the least padded one wins.
+    """
+    def __init__(
+            self,
+            records):
+        index = {}
+        widths = {}
+        for key, value in records.items():
+            number = normalize_hmdb_id(key)
+            if number is None:
+                continue
+            if number not in index or len(key) < widths[number]:
+                index[number] = value
+                widths[number] = len(key)
+        self.index = index
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file):
+        """Build the index from a JSON dictionary keyed by HMDB ID
+        """
+        with open(os.path.join(_path, _file)) as json_file:
+            return cls(json.load(json_file))
+
+    def __contains__(
+            self,
+            hmdb_id):
+        return normalize_hmdb_id(hmdb_id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(
+            self,
+            hmdb_id,
+            default=None):
+        return self.index.get(normalize_hmdb_id(hmdb_id), default)
@@ -0,0 +1,464 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import tempfile
+import threading
+import hashlib
+import json
+import time
+import re
+import os
+
+from .substructure_enrich import DATASETS, REFERENCES, CHUNK_SIZE, \
+    DatasetRegistry, enrich_dataset
+
+JOB_PATH = os.path.join(tempfile.gettempdir(), "electrum-substructure")
+JOB_WORKERS = 2
+JOB_TIMEOUT = 600
+JOB_MAX_AGE = 24 * 60 * 60
+JOB_MAX_SIZE = 2 * 1024 * 1024 * 1024
+CLEANUP_INTERVAL = 10 * 60
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+RUNNING_MARKER = "running"
+
+
+"""Functions
+"""
+def make_job_id(
+        dataset_hash,
+        TARGET,
+        THRESHOLD,
+        hierarchy=False,
+        reference_version=()):
+    """Return the job ID for an enrichment run
+
+    The ID is derived from the dataset hash, the run parameters and the
+    versions of the reference files, so identical requests map to the same
+    job and share its results until the references are rebuilt.
+    """
+    key = "\t".join([
+        dataset_hash,
+        str(TARGET),
+        repr(float(THRESHOLD)),
+        str(int(bool(hierarchy))),
+        ",".join(str(v) for v in reference_version)])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def write_atomic(
+        output_file,
+        data):
+    """Write a string to a file so readers never see a partial file
+    """
+    temp_file = output_file + ".%d.tmp" % os.getpid()
+    with open(temp_file, 'w') as f:
+        f.write(data)
+    os.replace(temp_file, output_file)
+
+
+def remove_file(
+        _file):
+    try:
+        os.remove(_file)
+    except FileNotFoundError:
+        pass
+
+
+def touch_file(
+        _file):
+    """Mark a spooled table or job result as recently used
+    """
+    try:
+        os.utime(_file)
+    except FileNotFoundError:
+        pass
+
+
+def process_alive(
+        pid):
+    """Return True if a process with this ID exists on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def run_job(
+        database_url,
+        TARGET,
+        THRESHOLD,
+        hierarchy,
+        job_file):
+    """Worker entry point: enrich a table on disk and store the results
+
+    Each worker process keeps its own dataset registry, so a table is only
+    parsed and cross-referenced once per worker. Results are written to
+    `job_file` + ".json", failures to `job_file` + ".error". The pending
+    marker is rewritten when the run starts, so the timeout counts from the
+    start rather than from when the job was queued.
+    """
+    try:
+        write_atomic(job_file + ".pending", RUNNING_MARKER)
+        dataset_id = DATASETS.register_file(database_url)
+        results = enrich_dataset(
+            dataset_id=dataset_id,
+            TARGET=TARGET,
+            THRESHOLD=THRESHOLD,
+            datasets=DATASETS,
+            references=REFERENCES,
+            hierarchy=hierarchy)
+        write_atomic(job_file + ".json", results.to_json())
+    except Exception as e:
+        write_atomic(job_file + ".error", json.dumps({"error": repr(e)}))
+    finally:
+        remove_file(job_file + ".pending")
+
+
+"""Classes
+"""
+class JobQueue:
+    """Background substructure enrichment backed by a local process pool
+
+    Uploaded tables are spooled to `_path` under their content hash and
+    enrichment runs are handed to worker processes. Job state lives on disk
+    next to the spooled tables (`<job>.pending`, `<job>.json`,
+    `<job>.error`), so any web worker can answer a status request and
+    finished results are reused for identical requests. The directory only
+    acts as a cache and can be cleared at any time.
+
+    A pending marker holds the ID of the web worker that queued the job
+    until a pool worker starts it. Queued jobs are lost only if that web
+    worker has exited (or, in the same process, the run is no longer
+    queued); running jobs are lost once they have run for `timeout`
+    seconds. Lost jobs are run again when next submitted. Every `CLEANUP_INTERVAL` seconds, tables
+    and results unused for `max_age` seconds are removed, then the least
+    recently used files until the directory holds at most `max_size` bytes.
+    """
+    def __init__(
+            self,
+            _path=JOB_PATH,
+            max_workers=JOB_WORKERS,
+            timeout=JOB_TIMEOUT,
+            max_age=JOB_MAX_AGE,
+            max_size=JOB_MAX_SIZE,
+            datasets=DATASETS,
+            references=REFERENCES):
+        self.path = _path
+        self.dataset_path = os.path.join(_path, "datasets")
+        self.job_path = os.path.join(_path, "jobs")
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_size = max_size
+        self.datasets = datasets
+        self.references = references
+        self._last_cleanup = 0
+        self._executor = None
+        self._hashes = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers)
+            return self._executor
+
+    def spool(
+            self,
+            database,
+            chunk_size=CHUNK_SIZE):
+        """Store an uploaded table under its content hash and return the hash
+
+        `database` may be a string, bytes or a seekable file object
+        """
+        self.cleanup()
+        dataset_id = DatasetRegistry.hash_database(database)
+        database_url = os.path.join(self.dataset_path, dataset_id + ".txt")
+        if os.path.exists(database_url):
+            touch_file(database_url)
+            return dataset_id
+
+        os.makedirs(self.dataset_path, exist_ok=True)
+        temp_file = database_url + ".%d.tmp" % os.getpid()
+        with open(temp_file, 'wb') as f:
+            if hasattr(database, 'read'):
+                database.seek(0)
+                while True:
+                    chunk = database.read(chunk_size)
+                    if not chunk:
+                        break
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf-8')
+                    f.write(chunk)
+                database.seek(0)
+            else:
+                if isinstance(database, str):
+                    database = database.encode('utf-8')
+                f.write(database)
+        os.replace(temp_file, database_url)
+
+        return dataset_id
+
+    def database_file(
+            self,
+            dataset_id):
+        """Return the path to a spooled or bundled table, or None if unknown
+        """
+        if dataset_id in self.datasets.bundled:
+            return os.path.join(self.datasets.path, dataset_id)
+
+        if JOB_ID_PATTERN.fullmatch(dataset_id) is None:
+            return None
+
+        database_url = os.path.join(self.dataset_path, dataset_id + ".txt")
+        if os.path.exists(database_url):
+            touch_file(database_url)
+            return database_url
+        return None
+
+    def dataset_hash(
+            self,
+            dataset_id,
+            database_url):
+        """Return the content hash of a table, caching bundled tables by mtime
+        """
+        if dataset_id not in self.datasets.bundled:
+            return dataset_id
+
+        mtime = os.stat(database_url).st_mtime_ns
+        cached = self._hashes.get(database_url)
+        if cached is None or cached[0] != mtime:
+            with open(database_url, 'rb') as database_file:
+                cached = (mtime, DatasetRegistry.hash_database(database_file))
+            self._hashes[database_url] = cached
+        return cached[1]
+
+    def submit(
+            self,
+            dataset_id,
+            TARGET,
+            THRESHOLD,
+            hierarchy=False):
+        """Queue an enrichment run and return its job ID
+
+        Raises KeyError if the dataset is neither bundled nor spooled
+        """
+        self.cleanup()
+        database_url = self.database_file(dataset_id)
+        if database_url is None:
+            raise KeyError(dataset_id)
+
+        TARGET = str(TARGET)
+        THRESHOLD = float(THRESHOLD)
+        hierarchy = bool(hierarchy)
+        job_id = make_job_id(
+            self.dataset_hash(dataset_id, database_url),
+            TARGET,
+            THRESHOLD,
+            hierarchy,
+            self.references.reference_version(hierarchy))
+        job_file = os.path.join(self.job_path, job_id)
+
+        if os.path.exists(job_file + ".json"):
+            touch_file(job_file + ".json")
+            return job_id
+        if not self.claim(job_file):
+            return job_id
+
+        remove_file(job_file + ".error")
+        future = self.executor.submit(
+            run_job,
+            database_url,
+            TARGET,
+            THRESHOLD,
+            hierarchy,
+            job_file)
+        with self._lock:
+            self._futures[job_file] = future
+        future.add_done_callback(
+            lambda f: self.job_done(f, job_file))
+
+        return job_id
+
+    def claim(
+            self,
+            job_file):
+        """Create the pending marker for a job
+
+        Returns False if another request is already running the job
+        """
+        os.makedirs(self.job_path, exist_ok=True)
+        marker = job_file + ".pending"
+        if os.path.exists(marker) and not self.pending_alive(job_file):
+            remove_file(marker)
+
+        try:
+            fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, str(os.getpid()).encode('utf-8'))
+        finally:
+            os.close(fd)
+        return True
+
+    def pending_alive(
+            self,
+            job_file):
+        """Return True if the job behind a pending marker is still queued or running
+
+        Markers written by a pool worker record a running job, which is
+        alive for `timeout` seconds after it started. Otherwise the marker
+        holds the ID of the web worker that queued the job; markers without
+        one, or not yet handed to this process's pool, fall back to the
+        timeout.
+        """
+        marker = job_file + ".pending"
+        try:
+            with open(marker) as f:
+                owner = f.read().strip()
+            started = os.stat(marker).st_mtime
+        except FileNotFoundError:
+            return False
+
+        if owner.isdigit():
+            pid = int(owner)
+            if pid != os.getpid():
+                return process_alive(pid)
+            with self._lock:
+                future = self._futures.get(job_file)
+            if future is not None:
+                return not future.done()
+        return time.time() - started <= self.timeout
+
+    def job_done(
+            self,
+            future,
+            job_file):
+        """Record jobs whose worker process failed before writing a result
+        """
+        with self._lock:
+            if self._futures.get(job_file) is future:
+                del self._futures[job_file]
+
+        error = future.exception()
+        if error is None:
+            return
+
+        write_atomic(job_file + ".error", json.dumps({"error": repr(error)}))
+        remove_file(job_file + ".pending")
+
+        # A crashed worker leaves the pool unusable; start a new one
+        if isinstance(error, BrokenProcessPool):
+            with self._lock:
+                self._executor = None
+
+    def cleanup(
+            self,
+            force=False):
+        """Remove spooled tables and job files that have not been used lately
+
+        Files are removed once unused for `max_age` seconds, then oldest
+        first while the spool and job directories exceed `max_size` bytes.
+        Pending markers are only removed once their job is lost (see
+        `pending_alive`) and `max_age` has passed. Runs at most once every
+        CLEANUP_INTERVAL seconds unless `force` is set; returns the number
+        of files removed.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_cleanup < CLEANUP_INTERVAL:
+                return 0
+            self._last_cleanup = now
+
+        files = []
+        removed = 0
+        for directory in (self.dataset_path, self.job_path):
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".pending"):
+                    if now - stat.st_mtime > self.max_age \
+                            and not self.pending_alive(entry.path[:-len(".pending")]):
+                        remove_file(entry.path)
+                        removed += 1
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        files.sort()
+        total_size = sum(f[1] for f in files)
+        for mtime, size, _file in files:
+            if now - mtime <= self.max_age and total_size <= self.max_size:
+                break
+            remove_file(_file)
+            total_size -= size
+            removed += 1
+
+        return removed
+
+    def status(
+            self,
+            job_id):
+        """Return (state, payload) for a job
+
+        state is "done" with the results JSON, "failed" with an error
+        message, or "pending" with None. Raises KeyError for unknown jobs.
+        """
+        if JOB_ID_PATTERN.fullmatch(job_id) is None:
+            raise KeyError(job_id)
+
+        job_file = os.path.join(self.job_path, job_id)
+        try:
+            with open(job_file + ".json") as f:
+                return "done", f.read()
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(job_file + ".error") as f:
+                return "failed", json.load(f)["error"]
+        except FileNotFoundError:
+            pass
+
+        if self.pending_alive(job_file):
+            return "pending", None
+
+        raise KeyError(job_id)
@@ -0,0 +1,248 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+import pandas as pd
+import numpy as np
+
+METABOLITE_COLUMN = "metabolite"
+PROTEIN_COLUMN = "query_protein"
+TAXONOMY_COLUMN = "taxonomy_ids"
+STAT_DTYPE = np.float32
+
+# Significance values keep double precision: p-values below the float32
+# range are common, and q-value thresholds must compare exactly as before
+EXACT_COLUMNS = ("p_value", "q_value")
+
+# Stands in for metabolites without substructure annotations, which the
+# enrichment counts as a CHEMONTID of NaN
+UNANNOTATED_TERM = ""
+
+
+"""Classes
+"""
+class MidasTable:
+    """Integer-coded MIDAS table
+
+    Metabolite and protein names are stored once (`metabolites`, `proteins`)
+    and each row refers to them by int32 code; missing names are coded -1.
+    Numeric columns are kept in `stats`, as float32 except for EXACT_COLUMNS.
+
+    Once annotated, each metabolite's CHEMONTIDs are stored as a CSR
+    incidence array: the terms of metabolite i are
+    `terms[term_ids[term_indptr[i]:term_indptr[i + 1]]]`, with one extra
+    slot at the end for rows without a metabolite name. Unannotated
+    metabolites hold the single term UNANNOTATED_TERM.
+    """
+    def __init__(
+            self,
+            metabolites,
+            proteins,
+            metabolite_codes,
+            protein_codes,
+            stats,
+            terms=None,
+            term_indptr=None,
+            term_ids=None):
+        self.metabolites = metabolites
+        self.proteins = proteins
+        self.metabolite_codes = metabolite_codes
+        self.protein_codes = protein_codes
+        self.stats = stats
+        self.terms = terms
+        self.term_indptr = term_indptr
+        self.term_ids = term_ids
+        self._protein_rows = None
+
+    @classmethod
+    def read(
+            cls,
+            database):
+        """Read a tab-delimited MIDAS table from a path or file object
+        """
+        table = pd.read_csv(
+            database,
+            sep='\t',
+            low_memory=False,
+            dtype={
+                METABOLITE_COLUMN: "category",
+                PROTEIN_COLUMN: "category"})
+        return cls.from_frame(table)
+
+    @classmethod
+    def from_frame(
+            cls,
+            table):
+        """Encode a MIDAS DataFrame
+
+        A `taxonomy_ids` column, as added by `annotate_metabolites`, is
+        turned into the CHEMONTID incidence array.
+        """
+        metabolite = table[METABOLITE_COLUMN].astype("category")
+        protein = table[PROTEIN_COLUMN].astype("category")
+
+        stats = {}
+        for column in table.columns:
+            if column in (METABOLITE_COLUMN, PROTEIN_COLUMN) \
+                    or not pd.api.types.is_numeric_dtype(table[column]):
+                continue
+            dtype = np.float64 if column in EXACT_COLUMNS else STAT_DTYPE
+            stats[column] = table[column].to_numpy(dtype=dtype)
+
+        midas_table = cls(
+            metabolites=np.asarray(metabolite.cat.categories, dtype=object),
+            proteins=np.asarray(protein.cat.categories, dtype=object),
+            metabolite_codes=metabolite.cat.codes.to_numpy(dtype=np.int32),
+            protein_codes=protein.cat.codes.to_numpy(dtype=np.int32),
+            stats=stats)
+
+        if TAXONOMY_COLUMN in table.columns:
+            mapping = pd.DataFrame({
+                METABOLITE_COLUMN: table[METABOLITE_COLUMN].to_numpy(),
+                TAXONOMY_COLUMN: table[TAXONOMY_COLUMN].to_numpy()
+            }).dropna(subset=[METABOLITE_COLUMN]) \
+                .drop_duplicates(METABOLITE_COLUMN) \
+                .set_index(METABOLITE_COLUMN)
+            midas_table = midas_table.annotate(mapping)
+
+        return midas_table
+
+    def __len__(self):
+        return len(self.metabolite_codes)
+
+    @property
+    def library_size(self):
+        """Number of unique metabolites, counting a missing name as one
+        """
+        return len(self.metabolites) + int((self.metabolite_codes < 0).any())
+
+    @property
+    def nbytes(self):
+        arrays = [
+            self.metabolite_codes,
+            self.protein_codes,
+            self.term_indptr,
+            self.term_ids
+        ] + list(self.stats.values())
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    @property
+    def protein_index(self):
+        return {p: i for i, p in enumerate(self.proteins)}
+
+    def rows(
+            self,
+            protein_code):
+        """Return the row positions for a protein code, in table order
+        """
+        if self._protein_rows is None:
+            order = np.argsort(self.protein_codes, kind='stable')
+            indptr = np.searchsorted(
+                self.protein_codes[order],
+                np.arange(len(self.proteins) + 1))
+            self._protein_rows = (order, indptr)
+
+        order, indptr = self._protein_rows
+        return order[indptr[protein_code]:indptr[protein_code + 1]]
+
+    def frame(
+            self,
+            rows=None,
+            columns=None):
+        """Decode rows (all by default) back into a DataFrame
+
+        Metabolite and protein names are returned as categoricals
+        """
+        if rows is None:
+            rows = slice(None)
+        if columns is None:
+            columns = list(self.stats)
+
+        table = pd.DataFrame({
+            METABOLITE_COLUMN: pd.Categorical.from_codes(
+                self.metabolite_codes[rows], self.metabolites),
+            PROTEIN_COLUMN: pd.Categorical.from_codes(
+                self.protein_codes[rows], self.proteins)
+        })
+        for column in columns:
+            table[column] = self.stats[column][rows]
+
+        return table
+
+    def annotate(
+            self,
+            mapping,
+            _delimiter=';'):
+        """Return a copy carrying CHEMONTID incidence from a `map_metabolites` table
+
+        Each metabolite's taxonomy IDs are split once here, so enrichment
+        never splits strings per row. Arrays other than the incidence are
+        shared with this table.
+        """
+        taxonomy = mapping[TAXONOMY_COLUMN].reindex(
+            pd.Index(self.metabolites)).tolist()
+        taxonomy.append(np.nan)
+
+        term_lookup = {}
+        term_ids = []
+        term_indptr = [0]
+        for taxonomy_ids in taxonomy:
+            if isinstance(taxonomy_ids, str):
+                terms = taxonomy_ids.split(_delimiter)
+            else:
+                terms = [UNANNOTATED_TERM]
+            for t in terms:
+                term_ids.append(term_lookup.setdefault(t, len(term_lookup)))
+            term_indptr.append(len(term_ids))
+
+        midas_table = MidasTable(
+            metabolites=self.metabolites,
+            proteins=self.proteins,
+            metabolite_codes=self.metabolite_codes,
+            protein_codes=self.protein_codes,
+            stats=self.stats,
+            terms=np.array(list(term_lookup), dtype=object),
+            term_indptr=np.array(term_indptr, dtype=np.int32),
+            term_ids=np.array(term_ids, dtype=np.int32))
+        midas_table._protein_rows = self._protein_rows
+        return midas_table
+
+    def row_terms(
+            self,
+            rows):
+        """Expand rows into one entry per (row, CHEMONTID)
+
+        Returns the position of each entry within `rows` and its index into
+        `terms`, in row order and in annotation order within a row
+        """
+        codes = self.metabolite_codes[rows]
+        codes = np.where(codes < 0, len(self.metabolites), codes)
+
+        starts = self.term_indptr[codes].astype(np.int64)
+        counts = self.term_indptr[codes + 1] - starts
+        row_positions = np.repeat(np.arange(len(codes)), counts)
+        offsets = np.arange(counts.sum()) \
+            - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return row_positions, \
+            self.term_ids[np.repeat(starts, counts) + offsets]
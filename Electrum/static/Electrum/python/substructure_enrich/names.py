@@ -0,0 +1,399 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+from bisect import bisect_left
+import numpy as np
+import json
+import csv
+import re
+import os
+
+from .columnar import ColumnFile, StringTable, save_columns
+from .hmdb import normalize_hmdb_id
+
+NAME_INDEX = "metabolite-names.npz"
+METABOLITE_FORMAT = 2
+SYNONYM_SOURCE = "Substructures-DB-latest.txt"
+SYNONYM_COLUMNS = ("common_name", "iupac_id", "synonyms")
+NAME_PATTERN = re.compile(r'\W+')
+DIGIT_PATTERN = re.compile(r'\d+')
+
+# Near matches must share this Dice similarity of padded name trigrams and
+# the same digits, so positional isomers (glucose 1- vs 6-phosphate) are
+# never confused
+FUZZY_THRESHOLD = 0.85
+NGRAM = 3
+
+
+"""Functions
+"""
+def normalize_name(
+        name):
+    """Return the lookup key of a metabolite name: word characters, lowercased
+    """
+    return NAME_PATTERN.sub('', name).lower()
+
+
+def name_ngrams(
+        key,
+        n=NGRAM):
+    """Return the distinct n-grams of a key padded with `$` at both ends
+    """
+    padded = '$' + key + '$'
+    return sorted(set(
+        padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))))
+
+
+def pack_reference(
+        metabolite_reference):
+    """Return a metabolites.json dictionary in the shared-record layout
+
+    Format 2 stores each distinct record once, as a list of values in
+    `fields` order, and maps every alias to the index of its record:
+
+        {"format": 2, "fields": [...], "records": [[...], ...],
+         "aliases": {"alias": 0, ...}}
+    """
+    if metabolite_reference.get("format") == METABOLITE_FORMAT:
+        return metabolite_reference
+
+    fields = []
+    records = {}
+    aliases = {}
+    for alias, entry in sorted(metabolite_reference.items()):
+        if not fields:
+            fields = list(entry)
+        values = tuple(entry.get(f, '') for f in fields)
+        aliases[alias] = records.setdefault(values, len(records))
+
+    return {
+        "format": METABOLITE_FORMAT,
+        "fields": fields,
+        "records": [list(v) for v in records],
+        "aliases": aliases
+    }
+
+
+def unpack_reference(
+        metabolite_reference):
+    """Return alias -> record for metabolites.json in either layout
+
+    Aliases of the same format 2 record share one dictionary
+    """
+    if metabolite_reference.get("format") != METABOLITE_FORMAT:
+        return metabolite_reference
+
+    fields = metabolite_reference["fields"]
+    records = [
+        dict(zip(fields, values))
+        for values in metabolite_reference["records"]]
+    return {
+        alias: records[i]
+        for alias, i in metabolite_reference["aliases"].items()}
+
+
+def read_reference(
+        _path,
+        _file="metabolites.json"):
+    """Read metabolites.json in either layout as alias -> record
+    """
+    with open(os.path.join(_path, _file)) as json_file:
+        return unpack_reference(json.load(json_file))
+
+
+def write_reference(
+        metabolite_reference,
+        output_file):
+    """Write metabolites.json in the compact shared-record layout
+    """
+    with open(output_file, "w") as json_file:
+        json.dump(
+            pack_reference(metabolite_reference),
+            json_file,
+            sort_keys=True,
+            separators=(',', ':'))
+    return output_file
+
+
+def read_synonyms(
+        synonym_file,
+        columns=SYNONYM_COLUMNS):
+    """Return numeric HMDB ID -> names from a buildSubstructureReference table
+
+    The table is streamed, so only the name columns are held in memory
+    """
+    synonyms = {}
+    with open(synonym_file, newline='') as _f:
+        for row in csv.DictReader(_f, delimiter='\t'):
+            number = normalize_hmdb_id(row.get("hmdb_id"))
+            if number is None:
+                continue
+            names = synonyms.setdefault(number, [])
+            for c in columns:
+                names.extend(n for n in (row.get(c) or '').split(';') if n != '')
+    return synonyms
+
+
+def write_name_index(
+        _path,
+        metabolite_file="metabolites.json",
+        synonym_file=SYNONYM_SOURCE,
+        _file=NAME_INDEX):
+    """Build the NameIndex of a reference directory and write it there
+
+    Synonyms are read from the buildSubstructureReference table if it is in
+    the same directory
+    """
+    metabolite_reference = read_reference(_path, metabolite_file)
+
+    synonyms = None
+    if os.path.isfile(os.path.join(_path, synonym_file)):
+        synonyms = read_synonyms(os.path.join(_path, synonym_file))
+
+    return save_columns(
+        os.path.join(_path, _file),
+        NameIndex.compile(metabolite_reference, synonyms))
+
+
+"""Classes
+"""
+class NameIndex:
+    """Metabolite name resolution index
+
+    Records (the fields of a metabolites.json entry) are stored once each,
+    and every distinct normalized name key points at one record. Keys come
+    from metabolites.json and, for records with an HMDB ID, from the common
+    name, IUPAC name and SDF synonyms of that ID. Names that match no key
+    fall back to the trigram index.
+
+    Arrays (all string tables can be memory-mapped):
+        fields          record field names
+        field_<name>    one string table per field
+        keys            sorted normalized name keys
+        key_records     record of each key
+        key_sources     0 for metabolites.json keys, 1 for synonyms
+        key_ngrams      number of distinct trigrams of each key
+        ngrams          sorted trigrams
+        ngram_indptr    per-trigram offsets into ngram_keys
+        ngram_keys      keys containing each trigram, ascending
+    """
+    def __init__(
+            self,
+            columns):
+        self.columns = columns
+        self.fields = list(StringTable.from_columns(columns, 'fields'))
+        self.field_tables = [
+            StringTable.from_columns(columns, 'field_' + f)
+            for f in self.fields]
+        self.keys = StringTable.from_columns(columns, 'keys')
+        self.ngrams = StringTable.from_columns(columns, 'ngrams')
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file=NAME_INDEX):
+        return cls(ColumnFile.load(_path, _file))
+
+    @classmethod
+    def from_reference(
+            cls,
+            metabolite_reference,
+            synonyms=None):
+        """Build an in-memory index from a metabolites.json dictionary (either layout)
+
+        `synonyms` maps numeric HMDB IDs to further names, see `read_synonyms`
+        """
+        return cls(cls.compile(metabolite_reference, synonyms))
+
+    @classmethod
+    def load_json(
+            cls,
+            _path,
+            _file):
+        """Build an index from metabolites.json alone, without synonyms
+        """
+        return cls.from_reference(read_reference(_path, _file))
+
+    @staticmethod
+    def compile(
+            metabolite_reference,
+            synonyms=None):
+        """Return the arrays of a NameIndex
+
+        Keys already normalized in metabolites.json take precedence, then
+        the remaining metabolites.json names, then synonyms; the first record
+        seen for a key keeps it.
+        """
+        metabolite_reference = unpack_reference(metabolite_reference)
+        records = {}
+        key_records = {}
+        key_sources = {}
+        fields = []
+
+        def add_key(name, record, source):
+            key = normalize_name(name)
+            if key != '' and key not in key_records:
+                key_records[key] = record
+                key_sources[key] = source
+
+        entries = sorted(metabolite_reference.items())
+        for name, entry in entries:
+            if not fields:
+                fields = list(entry)
+            values = tuple(str(entry.get(f) or '') for f in fields)
+            records.setdefault(values, len(records))
+
+        for exact in (True, False):
+            for name, entry in entries:
+                if (normalize_name(name) == name) != exact:
+                    continue
+                values = tuple(str(entry.get(f) or '') for f in fields)
+                add_key(name, records[values], 0)
+
+        if synonyms and "hmdb_id" in fields:
+            hmdb_field = fields.index("hmdb_id")
+            for values, record in records.items():
+                number = normalize_hmdb_id(values[hmdb_field])
+                for name in synonyms.get(number, ()):
+                    add_key(name, record, 1)
+
+        keys = sorted(key_records)
+        postings = {}
+        key_ngrams = []
+        for i, key in enumerate(keys):
+            grams = name_ngrams(key)
+            key_ngrams.append(len(grams))
+            for g in grams:
+                postings.setdefault(g, []).append(i)
+        ngrams = sorted(postings)
+        ngram_indptr = np.zeros(len(ngrams) + 1, dtype=np.int64)
+        ngram_indptr[1:] = np.cumsum([len(postings[g]) for g in ngrams])
+
+        record_values = list(records)
+        arrays = StringTable.from_strings(fields).arrays('fields')
+        for j, f in enumerate(fields):
+            arrays.update(StringTable.from_strings(
+                [v[j] for v in record_values]).arrays('field_' + f))
+        arrays.update(StringTable.from_strings(keys).arrays('keys'))
+        arrays.update(StringTable.from_strings(ngrams).arrays('ngrams'))
+        arrays["key_records"] = np.array(
+            [key_records[k] for k in keys], dtype=np.int32)
+        arrays["key_sources"] = np.array(
+            [key_sources[k] for k in keys], dtype=np.int8)
+        arrays["key_ngrams"] = np.array(key_ngrams, dtype=np.int32)
+        arrays["ngram_indptr"] = ngram_indptr
+        arrays["ngram_keys"] = np.array(
+            [i for g in ngrams for i in postings[g]], dtype=np.int32)
+        return arrays
+
+    def __len__(self):
+        return len(self.keys)
+
+    def record(
+            self,
+            i):
+        """Return record `i` as a dictionary of its fields
+        """
+        return {f: t[i] for f, t in zip(self.fields, self.field_tables)}
+
+    def find(
+            self,
+            key):
+        """Return the position of a normalized key, or -1
+        """
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def find_fuzzy(
+            self,
+            key,
+            threshold=FUZZY_THRESHOLD):
+        """Return the position of the closest key by trigram similarity, or -1
+
+        Only keys with the same digits as `key` are considered, and the best
+        key must be unique
+        """
+        grams = name_ngrams(key)
+        indptr = self.columns["ngram_indptr"]
+        ngram_keys = self.columns["ngram_keys"]
+        hits = []
+        for g in grams:
+            j = bisect_left(self.ngrams, g)
+            if j < len(self.ngrams) and self.ngrams[j] == g:
+                hits.append(ngram_keys[indptr[j]:indptr[j + 1]])
+        if len(hits) == 0:
+            return -1
+
+        candidates, shared = np.unique(
+            np.concatenate(hits), return_counts=True)
+        scores = 2 * shared / (len(grams) + self.columns["key_ngrams"][candidates])
+        order = np.argsort(-scores, kind='stable')
+
+        digits = DIGIT_PATTERN.findall(key)
+        best = -1
+        best_score = 0.
+        for c, score in zip(candidates[order].tolist(), scores[order].tolist()):
+            if score < threshold or (best != -1 and score < best_score):
+                break
+            if DIGIT_PATTERN.findall(self.keys[c]) != digits:
+                continue
+            if best != -1:
+                # Tied with a different record: ambiguous
+                if self.columns["key_records"][c] != self.columns["key_records"][best]:
+                    return -1
+                continue
+            best, best_score = c, score
+        return best
+
+    def resolve(
+            self,
+            name,
+            fuzzy=True):
+        """Return (record, matched key, how) for a metabolite name
+
+        `how` is `exact`, `synonym` or `fuzzy`; unmatched names return
+        (None, None, None)
+        """
+        key = normalize_name(name)
+        i = self.find(key)
+        how = None
+        if i != -1:
+            how = 'exact' if self.columns["key_sources"][i] == 0 else 'synonym'
+        elif fuzzy and key != '':
+            i = self.find_fuzzy(key)
+            how = 'fuzzy'
+        if i == -1:
+            return None, None, None
+        return self.record(self.columns["key_records"][i]), self.keys[i], how
+
+    def lookup(
+            self,
+            name,
+            fuzzy=True):
+        """Return the record for a metabolite name, or None
+        """
+        return self.resolve(name, fuzzy)[0]
@@ -23,18 +23,46 @@ from __future__ import print_function
 """Import dependencies
 """
 from django.http import HttpResponse
-from collections import Counter
+from collections import Counter, OrderedDict, ChainMap
 from fisher import pvalue_npy
+from io import BytesIO
 import statsmodels.api as sm
 import pandas as pd
 import numpy as np
+import threading
+import hashlib
 import json
 import re
 import sys
 import os
 
+from .contingency import ContingencyTables, CONTINGENCY_TABLES
+from .midas_table import MidasTable, UNANNOTATED_TERM
+from .hierarchy import HierarchyClosure, HIERARCHY_DICTIONARY
+from .hmdb import HMDBIndex
+from .substructures import SubstructureTable, SUBSTRUCTURE_TABLE
+from .columnar import RecordMapping, StringMapping
+from .names import NameIndex, NAME_INDEX, read_reference
+
 MIDAS_DATA = "MIDAS_unified-latest.txt"
 CHEMONTID_DICTIONARY = "CHEMONTID-mapper.json"
+METABOLITE_REFERENCE = "metabolites.json"
+METABOLITE_TABLE = "metabolites.npz"
+CHEMONTID_TABLE = "CHEMONTID-mapper.npz"
+SUBSTRUCTURE_DICTIONARY = "CHEMONTID-substructure-dictionary.json"
+
+# Memory-mapped versions of the JSON references and their loaders; when
+# present, every worker process maps the same file from the page cache
+COMPILED_REFERENCES = {
+    METABOLITE_REFERENCE: (METABOLITE_TABLE, RecordMapping.load),
+    CHEMONTID_DICTIONARY: (CHEMONTID_TABLE, StringMapping.load),
+    SUBSTRUCTURE_DICTIONARY: (SUBSTRUCTURE_TABLE, SubstructureTable.load),
+}
+
+BUNDLED_DATASETS = ("MIDAS-latest.txt",)
+MAX_DATASETS = 8
+CHUNK_SIZE = 1024 * 1024
+DATASET_HEADER = "X-Electrum-Dataset"
 DATA_PATH = os.path.join(
     os.path.dirname(__file__),
     "..",
@@ -82,6 +110,20 @@ def import_database_str(
     )
 
 
+def import_database_file(
+        database,
+        index_col=None):
+    """Import open file object as tab-delimited table
+    """
+
+    return pd.read_csv(
+        database,
+        sep='\t',
+        index_col=index_col,
+        low_memory=False
+    )
+
+
 def import_json(
         _path,
         _file):
@@ -93,78 +135,631 @@ def import_json(
     return data
 
 
+def hash_file(
+        _path,
+        _file):
+    """Return the SHA-256 hex digest of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(os.path.join(_path, _file), 'rb') as _f:
+        for chunk in iter(lambda: _f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+"""Classes
+"""
+class UnknownDataset(KeyError):
+    """Raised for a dataset ID that is not (or no longer) registered
+    """
+
+
+class ReferenceStore:
+    """Process-wide cache of the JSON reference files used for enrichment
+
+    Each file is parsed once per worker and re-parsed only when its
+    modification time changes, so references can be swapped on disk without
+    restarting the server. Returned objects are shared and must not be
+    modified by callers.
+    """
+    def __init__(
+            self,
+            _path=DATA_PATH):
+        self.path = _path
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            _file,
+            loader=import_json):
+        """Return the parsed contents of a reference file, reloading if stale
+        """
+        file_path = os.path.join(self.path, _file)
+        mtime = os.stat(file_path).st_mtime_ns
+
+        with self._lock:
+            cached = self._cache.get((file_path, loader))
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, loader(self.path, _file))
+                self._cache[(file_path, loader)] = cached
+
+        return cached[1]
+
+    def version(
+            self,
+            *files):
+        """Return the current modification times of `files`
+        """
+        return tuple(
+            os.stat(os.path.join(self.path, _file)).st_mtime_ns
+            for _file in files)
+
+    def annotation_files(
+            self,
+            hierarchy=False):
+        """Return the reference files metabolite annotations are built from
+
+        The substructure and metabolite references are listed in whichever
+        form (compiled table or JSON) is currently used
+        """
+        reference_files = (
+            self.reference_file(SUBSTRUCTURE_DICTIONARY),
+            self.reference_file(
+                METABOLITE_REFERENCE, compiled_file=NAME_INDEX))
+        if hierarchy:
+            reference_files += (HIERARCHY_DICTIONARY,)
+        return reference_files
+
+    def annotation_hash(
+            self,
+            hierarchy=False):
+        """Return a content hash of the references annotations are built from
+
+        Each file is hashed once per modification time
+        """
+        digest = hashlib.sha256()
+        for _file in self.annotation_files(hierarchy):
+            digest.update(_file.encode('utf-8') + b'\0')
+            digest.update(self.get(_file, loader=hash_file).encode('utf-8'))
+        return digest.hexdigest()
+
+    def reference_version(
+            self,
+            hierarchy=False):
+        """Return the modification times of the references an enrichment reads
+
+        Covers the annotation references, the CHEMONTID names and, when they
+        have been built, the precomputed contingency tables
+        """
+        reference_files = self.annotation_files(hierarchy) \
+            + (self.reference_file(CHEMONTID_DICTIONARY),)
+        if os.path.isfile(os.path.join(self.path, CONTINGENCY_TABLES)):
+            reference_files += (CONTINGENCY_TABLES,)
+        return self.version(*reference_files)
+
+    def clear(
+            self):
+        """Drop all cached references
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def reference_file(
+            self,
+            _file,
+            compiled_file=None):
+        """Return the file to read for a JSON reference
+
+        The compiled table (by default the one in COMPILED_REFERENCES) is
+        used if it exists and is not older than the JSON file, which may be
+        absent once the table is built
+        """
+        if compiled_file is None:
+            compiled = COMPILED_REFERENCES.get(_file)
+            if compiled is None:
+                return _file
+            compiled_file = compiled[0]
+
+        compiled_path = os.path.join(self.path, compiled_file)
+        json_path = os.path.join(self.path, _file)
+        if not os.path.isfile(compiled_path):
+            return _file
+        if os.path.isfile(json_path) \
+                and os.stat(json_path).st_mtime_ns > os.stat(compiled_path).st_mtime_ns:
+            return _file
+        return compiled_file
+
+    def get_reference(
+            self,
+            _file,
+            loader=import_json):
+        """Return a JSON reference, from its compiled table when available
+        """
+        reference_file = self.reference_file(_file)
+        if reference_file != _file:
+            loader = COMPILED_REFERENCES[_file][1]
+        return self.get(reference_file, loader=loader)
+
+    @property
+    def metabolite_reference(self):
+        return self.get_reference(METABOLITE_REFERENCE, loader=read_reference)
+
+    @property
+    def name_index(self):
+        """Name resolution index for metabolites.json
+
+        The prebuilt index, which adds SDF synonyms, is used when it is
+        current; otherwise an index of metabolites.json alone is built
+        """
+        _file = self.reference_file(
+            METABOLITE_REFERENCE,
+            compiled_file=NAME_INDEX)
+        if _file == NAME_INDEX:
+            return self.get(NAME_INDEX, loader=NameIndex.load)
+        return self.get(METABOLITE_REFERENCE, loader=NameIndex.load_json)
+
+    @property
+    def substructure_dictionary(self):
+        """Substructure records indexed by numeric HMDB ID
+        """
+        return self.get_reference(
+            SUBSTRUCTURE_DICTIONARY, loader=HMDBIndex.load)
+
+    @property
+    def chemontid_reference(self):
+        return self.get_reference(CHEMONTID_DICTIONARY)
+
+    @property
+    def contingency_tables(self):
+        """Precomputed contingency tables, or None if they have not been built
+        """
+        if not os.path.isfile(os.path.join(self.path, CONTINGENCY_TABLES)):
+            return None
+        return self.get(CONTINGENCY_TABLES, loader=ContingencyTables.load)
+
+    @property
+    def hierarchy(self):
+        """Ancestor closure of the CHEMONTID hierarchy
+        """
+        return self.get(HIERARCHY_DICTIONARY, loader=HierarchyClosure.load)
+
+    def term_reference(
+            self,
+            hierarchy=False):
+        """Return CHEMONTID names, falling back to the hierarchy for ancestors
+        """
+        if hierarchy:
+            return ChainMap(self.chemontid_reference, self.hierarchy.names)
+        return self.chemontid_reference
+
+
+class DatasetRegistry:
+    """Server-side store of parsed MIDAS tables keyed by content hash
+
+    A table is hashed and parsed once when registered; its cross-referenced
+    form is built on first use and rebuilt only when the reference files
+    change. Later enrichment calls only need to pass the dataset ID. The
+    least recently used tables are evicted beyond `max_datasets`.
+
+    Bundled tables in `bundled` can be requested by file name and are read
+    from `_path` on demand, so they never need to be uploaded.
+    """
+    def __init__(
+            self,
+            _path=DATA_PATH,
+            max_datasets=MAX_DATASETS,
+            bundled=BUNDLED_DATASETS):
+        self.path = _path
+        self.max_datasets = max_datasets
+        self.bundled = bundled
+        self._datasets = OrderedDict()
+        self._aliases = {}
+        self._stale_tables = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_database(
+            database,
+            chunk_size=CHUNK_SIZE):
+        """Return the dataset ID for a tab-delimited table
+
+        File objects are hashed in chunks and rewound afterwards
+        """
+        digest = hashlib.sha256()
+        if hasattr(database, 'read'):
+            database.seek(0)
+            while True:
+                chunk = database.read(chunk_size)
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+            database.seek(0)
+        else:
+            if isinstance(database, str):
+                database = database.encode('utf-8')
+            digest.update(database)
+
+        return digest.hexdigest()
+
+    def register(
+            self,
+            database):
+        """Parse and store a tab-delimited table, returning its dataset ID
+
+        `database` may be a string, bytes or a seekable file object; file
+        objects are streamed into the table reader without being read into
+        memory first. Tables are kept integer-coded (see MidasTable).
+        """
+        dataset_id = self.hash_database(database)
+
+        with self._lock:
+            if dataset_id in self._datasets:
+                self._datasets.move_to_end(dataset_id)
+                return dataset_id
+
+        if not hasattr(database, 'read'):
+            if isinstance(database, str):
+                database = database.encode('utf-8')
+            database = BytesIO(database)
+        table = MidasTable.read(database)
+
+        with self._lock:
+            self._datasets[dataset_id] = {
+                "table": table,
+                "library_size": table.library_size,
+                "annotations": {},
+                "crossref": {},
+                "contingency": {}
+            }
+            self._datasets.move_to_end(dataset_id)
+            while len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+
+        return dataset_id
+
+    def register_file(
+            self,
+            _file):
+        """Register a bundled table from disk, re-reading it only if changed
+        """
+        file_path = os.path.join(self.path, _file)
+        mtime = os.stat(file_path).st_mtime_ns
+
+        with self._lock:
+            alias = self._aliases.get(file_path)
+            if alias is not None \
+                    and alias[0] == mtime \
+                    and alias[1] in self._datasets:
+                self._datasets.move_to_end(alias[1])
+                return alias[1]
+
+        with open(file_path, 'rb') as database_file:
+            dataset_id = self.register(database_file)
+
+        with self._lock:
+            self._aliases[file_path] = (mtime, dataset_id)
+
+        return dataset_id
+
+    def resolve(
+            self,
+            dataset_id):
+        """Return the registered dataset ID for an ID or bundled file name
+
+        Raises UnknownDataset if the dataset has not been registered in this
+        process or has since been evicted
+        """
+        if dataset_id in self.bundled:
+            return self.register_file(dataset_id)
+
+        with self._lock:
+            if dataset_id not in self._datasets:
+                raise UnknownDataset(dataset_id)
+            self._datasets.move_to_end(dataset_id)
+
+        return dataset_id
+
+    def __contains__(
+            self,
+            dataset_id):
+        return dataset_id in self.bundled or dataset_id in self._datasets
+
+    def table(
+            self,
+            dataset_id):
+        """Return the parsed MidasTable for a dataset
+        """
+        dataset_id = self.resolve(dataset_id)
+        with self._lock:
+            return self._datasets[dataset_id]["table"]
+
+    def library_size(
+            self,
+            dataset_id):
+        """Return the number of unique metabolites in a dataset
+        """
+        dataset_id = self.resolve(dataset_id)
+        with self._lock:
+            return self._datasets[dataset_id]["library_size"]
+
+    def annotations(
+            self,
+            dataset_id,
+            references,
+            hierarchy=False):
+        """Return the substructure annotations for each unique metabolite
+
+        Built once per dataset and rebuilt only when the reference files
+        change. With `hierarchy`, taxonomy IDs are propagated to all of their
+        ChemOnt ancestors.
+        """
+        dataset_id = self.resolve(dataset_id)
+        version = references.version(
+            *references.annotation_files(hierarchy))
+
+        with self._lock:
+            entry = self._datasets[dataset_id]
+            cached = entry["annotations"].get(hierarchy)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        if hierarchy:
+            mapping = references.hierarchy.propagate(
+                self.annotations(
+                    dataset_id=dataset_id,
+                    references=references))
+        else:
+            mapping = map_metabolites(
+                metabolites=entry["table"].metabolites,
+                substructure_dictionary=references.substructure_dictionary,
+                metabolite_reference=references.name_index)
+
+        with self._lock:
+            entry["annotations"][hierarchy] = (version, mapping)
+
+        return mapping
+
+    def crossref(
+            self,
+            dataset_id,
+            references,
+            hierarchy=False):
+        """Return the whole dataset cross-referenced with the substructure database
+
+        The result is a MidasTable carrying per-metabolite CHEMONTID incidence
+        """
+        mapping = self.annotations(
+            dataset_id=dataset_id,
+            references=references,
+            hierarchy=hierarchy)
+        dataset_id = self.resolve(dataset_id)
+
+        with self._lock:
+            entry = self._datasets[dataset_id]
+            cached = entry["crossref"].get(hierarchy)
+            if cached is not None and cached[0] is mapping:
+                return cached[1]
+
+        crossref_table = entry["table"].annotate(mapping)
+
+        with self._lock:
+            entry["crossref"][hierarchy] = (mapping, crossref_table)
+
+        return crossref_table
+
+    def contingency(
+            self,
+            dataset_id,
+            TARGET,
+            references,
+            hierarchy=False):
+        """Return contingency tables covering `TARGET` for a dataset
+
+        Tables precomputed for this dataset by buildContingencyTables are used
+        when available and built from the current references; otherwise the
+        protein's table is built on first use and kept, so later thresholds
+        for the same protein skip the pipeline
+        """
+        dataset_id = self.resolve(dataset_id)
+        precomputed = references.contingency_tables
+        if precomputed is not None \
+                and precomputed.dataset_id == dataset_id \
+                and precomputed.hierarchy == hierarchy \
+                and TARGET in precomputed:
+            reference_hash = references.annotation_hash(hierarchy)
+            if precomputed.reference_hash == reference_hash:
+                return precomputed
+
+            stale = (precomputed.reference_hash, reference_hash, hierarchy)
+            if stale not in self._stale_tables:
+                self._stale_tables.add(stale)
+                print(
+                    "Skipping precomputed contingency tables built from other "
+                    "reference files; rerun buildContingencyTables")
+
+        mapping = self.annotations(
+            dataset_id=dataset_id,
+            references=references,
+            hierarchy=hierarchy)
+        with self._lock:
+            entry = self._datasets[dataset_id]
+            cached = entry["contingency"].get((TARGET, hierarchy))
+            if cached is not None and cached[0] is mapping:
+                return cached[1]
+
+        tables = ContingencyTables.from_table(
+            unified_table=self.crossref(
+                dataset_id=dataset_id,
+                references=references,
+                hierarchy=hierarchy),
+            library_size=self.library_size(dataset_id),
+            dataset_id=dataset_id,
+            proteins=[TARGET],
+            hierarchy=hierarchy)
+
+        with self._lock:
+            entry["contingency"][(TARGET, hierarchy)] = (mapping, tables)
+
+        return tables
+
+
+# Shared by every caller in this process (web views and command line)
+REFERENCES = ReferenceStore()
+DATASETS = DatasetRegistry()
+
+
+"""Functions
+"""
+def lookup_substructures(
+        hmdb_id,
+        substructure_dictionary):
+    """Find an HMDB ID in the substructure database, allowing for zero-padding
+
+    `substructure_dictionary` is an HMDBIndex or a dictionary keyed by HMDB
+    ID. Returns the matching substructure record, or None
+    """
+    if not isinstance(substructure_dictionary, HMDBIndex):
+        substructure_dictionary = HMDBIndex(substructure_dictionary)
+    return substructure_dictionary.get(hmdb_id)
+
+
+def map_metabolites(
+        metabolites,
+        substructure_dictionary,
+        metabolite_reference,
+        fuzzy=True):
+    """Build a metabolite -> (HMDB_ID, taxonomy_ids, taxonomy_terms) table
+
+    Each unique metabolite name is resolved once through a NameIndex (a
+    metabolites.json dictionary is indexed first); with `fuzzy`, names
+    without an exact or synonym match may match by trigram similarity.
+    Isoform lists (`name1;name2`) are matched by their first name.
+    """
+    if not isinstance(substructure_dictionary, HMDBIndex):
+        substructure_dictionary = HMDBIndex(substructure_dictionary)
+    if not isinstance(metabolite_reference, NameIndex):
+        metabolite_reference = NameIndex.from_reference(metabolite_reference)
+
+    names = pd.Series(pd.unique(pd.Series(metabolites).dropna()), dtype=object)
+    first_names = names.str.split(';').str[0]
+
+    mapping = {}
+    non_mappers = []
+    non_matchers = []
+    non_hmdb = []
+    near_matches = []
+    for name, metabolite in zip(names, first_names):
+
+        entry, key, how = metabolite_reference.resolve(
+            metabolite,
+            fuzzy=fuzzy)
+        if entry is None:
+            non_matchers.append(metabolite)
+            continue
+        if how == 'fuzzy':
+            near_matches.append((metabolite, key))
+
+        hmdb_id = entry['hmdb_id']
+        if 'hmdb' not in str(hmdb_id).lower():
+            non_mappers.append(metabolite)
+            continue
+
+        hmdb_id = str(hmdb_id)
+        record = lookup_substructures(
+            hmdb_id=hmdb_id,
+            substructure_dictionary=substructure_dictionary)
+        if record is None:
+            non_hmdb.append((hmdb_id, metabolite))
+            mapping[name] = (hmdb_id, np.nan, np.nan)
+        else:
+            mapping[name] = (
+                hmdb_id,
+                record['taxonomy_ids'],
+                record['taxonomy_terms'])
+
+    # Report each unmapped metabolite once
+    for metabolite, key in dict.fromkeys(near_matches):
+        print('Matched', metabolite, 'by similarity to', key)
+    for metabolite in dict.fromkeys(non_matchers):
+        print('Unable to match', metabolite)
+    for metabolite in dict.fromkeys(non_mappers):
+        print("HMDB ID not available for", metabolite)
+    for hmdb_id, metabolite in dict.fromkeys(non_hmdb):
+        print(
+            'Unable to find', hmdb_id,
+            '(', metabolite, ') in substructure database')
+
+    return pd.DataFrame.from_dict(
+        mapping,
+        orient='index',
+        columns=['HMDB_ID', 'taxonomy_ids', 'taxonomy_terms'],
+        dtype=object)
+
+
+def annotate_metabolites(
+        midas_table,
+        mapping):
+    """Join per-metabolite annotations from `map_metabolites` onto MIDAS rows
+    """
+    midas_table_c = midas_table.drop(
+        columns=mapping.columns,
+        errors='ignore')
+
+    return midas_table_c.join(mapping, on='metabolite')
+
 
 def crossref_databases(
         midas_table,
         substructure_dictionary,
-        metabolite_reference):
+        metabolite_reference,
+        TARGET=None):
     """Crossreference MIDAS data with the substructure database using the Electrum metabolite mapping reference
+
+    Adds `HMDB_ID`, `taxonomy_ids` and `taxonomy_terms` columns, which are
+    left empty for metabolites that cannot be mapped. If `TARGET` is given,
+    only the rows for that query protein are returned.
     """
-    # Use to prevent excessive warning messages
-    non_mappers = set()
-    non_matchers = set()
-    non_hmdb = set()
+    mapping = map_metabolites(
+        metabolites=midas_table['metabolite'],
+        substructure_dictionary=substructure_dictionary,
+        metabolite_reference=metabolite_reference)
 
-    midas_table_c = midas_table.copy()
+    if TARGET is not None:
+        midas_table = midas_table.loc[midas_table['query_protein'] == TARGET]
 
-    # Add HMDB ID to MIDAS table
-    # Add substructure annotations to MIDAS table
-    for index, row in midas_table_c.iterrows():
+    return annotate_metabolites(
+        midas_table=midas_table,
+        mapping=mapping)
 
-        if ';' in row['metabolite']:
-            metabolite = row['metabolite'].split(';')[0]
-        else:
-            metabolite = row['metabolite']
-
-        metabolite_simplified = re.sub(r'\W+', '', metabolite).lower()
-
-        if metabolite_simplified in metabolite_reference:
-            hmdb_id = metabolite_reference[metabolite_simplified]['hmdb_id']
-
-            if 'hmdb' in str(hmdb_id).lower():
-
-                # Add HMDB ID
-                midas_table_c.at[index, 'HMDB_ID'] = str(hmdb_id)
-
-                # Add sub-structure IDs and names
-                i = 0
-                while i < 12:
-                    hmdb_id = 'HMDB' + hmdb_id.replace('HMDB', '').zfill(i)
-                    if hmdb_id in substructure_dictionary:
-                        midas_table_c.at[index, 'taxonomy_ids'] = (
-                            substructure_dictionary[hmdb_id]['taxonomy_ids']
-                        )
-                        midas_table_c.at[index, 'taxonomy_terms'] = (
-                            substructure_dictionary[hmdb_id]['taxonomy_terms']
-                        )
-                        break
-                    else:
-                        i += 1
-                else:
-                    if metabolite not in non_hmdb:
-                        print(
-                            'Unable to find', hmdb_id,
-                            '(', metabolite, ') in substructure database')
-                        non_hmdb.add(metabolite)
-
-            else:
-                if metabolite not in non_mappers:
-                    print("HMDB ID not available for", metabolite)
-                    non_mappers.add(metabolite)
-        else:
-            if metabolite not in non_matchers:
-                print('Unable to match', metabolite)
-                non_matchers.add(metabolite)
 
-    return midas_table_c
+def term_names(
+        chemontids,
+        chemontid_reference):
+    """Return the common name of each CHEMONTID, or the ID if it has none
+
+    Names are looked up one at a time, so a compiled reference is never
+    copied in full
+    """
+    names = []
+    for t in chemontids:
+        name = chemontid_reference.get(t)
+        names.append(name if isinstance(name, str) else t)
+    return names
 
 
 def substructure_enrichment(
         unified_table,
         chemontid_reference,
         TARGET,
-        THRESHOLD):
+        THRESHOLD,
+        library_size=None):
     """Perform enrichment analysis
+
+    `unified_table` may hold only the `TARGET` rows if the number of unique
+    metabolites in the whole library is passed as `library_size`
     """ 
     # Target selection table 
     unified_table_target = unified_table.loc[unified_table['query_protein'] == TARGET]
@@ -189,7 +784,10 @@ def substructure_enrichment(
     results_table["C"] = results_table["CHEMONTID"].map(expected_counter).fillna(results_table["C"])
 
     ### (D) Total number of metabolites in library
-    LIBRARY_SIZE = len(unified_table["metabolite"].unique().tolist()) 
+    if library_size is None:
+        LIBRARY_SIZE = len(unified_table["metabolite"].unique().tolist()) 
+    else:
+        LIBRARY_SIZE = library_size
     results_table["D"] = LIBRARY_SIZE - results_table["C"]
 
     # Generate OBSERVED CHEMONTID distributions
@@ -206,6 +804,18 @@ def substructure_enrichment(
 
     results_table = results_table[["CHEMONTID", "A", "B", "C", "D"]]
 
+    return score_enrichment(
+        results_table=results_table,
+        chemontid_reference=chemontid_reference,
+        THRESHOLD=THRESHOLD)
+
+
+def score_enrichment(
+        results_table,
+        chemontid_reference,
+        THRESHOLD):
+    """Run Fisher's exact test and BH correction over CHEMONTID A/B/C/D counts
+    """
 
     #Fisher Exact Test. For each row, runs Fisher Exact on 4 columns and outputs final result to new column.
     #Vectorizing the below could speed it up if we still want live p-value updates:
@@ -216,7 +826,7 @@ def substructure_enrichment(
 
     results_table["Fold_change"] = (results_table["A"] / results_table["B"]) / (results_table["C"] / results_table["D"])
 
-    _arr = results_table[['A', 'B', 'C', 'D']].to_numpy(dtype=np.uint, copy=True)
+    _arr = results_table[['A', 'B', 'C', 'D']].to_numpy(dtype=np.uint32, copy=True)
     _, _, twosided = pvalue_npy(_arr[:, 0], _arr[:, 1], _arr[:, 2], _arr[:, 3])
     results_table["P_value"] = twosided
     results_table = results_table.sort_values(by="P_value")
@@ -229,49 +839,212 @@ def substructure_enrichment(
     )
 
     # Add common substructure names to results table 
-    results_table["Term"] = results_table["CHEMONTID"].map(chemontid_reference).fillna(results_table["CHEMONTID"])
+    results_table["Term"] = term_names(
+        chemontids=results_table["CHEMONTID"],
+        chemontid_reference=chemontid_reference)
 
     return results_table
 
 
-def __main__(TARGET, THRESHOLD, DATABASE):
+def batch_enrichment(
+        unified_table,
+        chemontid_reference,
+        THRESHOLD,
+        library_size=None,
+        proteins=None):
+    """Perform enrichment analysis for every query protein at once
+
+    `unified_table` is an annotated MidasTable or a cross-referenced
+    DataFrame. Builds protein x CHEMONTID count matrices, runs Fisher's exact
+    test once over all protein/CHEMONTID pairs and applies BH correction
+    within each protein. Returns a long-form table sorted by protein and
+    P-value with the columns of `substructure_enrichment` plus
+    `query_protein`.
+    """
+    if not isinstance(unified_table, MidasTable):
+        unified_table = MidasTable.from_frame(unified_table)
+    if library_size is None:
+        library_size = unified_table.library_size
+
+    rows = unified_table.protein_codes >= 0
+    if proteins is not None:
+        rows &= np.isin(
+            unified_table.proteins[np.maximum(unified_table.protein_codes, 0)],
+            list(proteins))
+    rows = np.flatnonzero(rows)
+
+    protein_codes, protein_names = pd.factorize(
+        unified_table.protein_codes[rows], sort=True)
+    protein_names = unified_table.proteins[protein_names]
+    metabolite_codes = unified_table.metabolite_codes[rows]
+    passing = unified_table.stats['q_value'][rows] < THRESHOLD
+
+    # One entry per (row, CHEMONTID); missing annotations count as their own term
+    row_positions, row_terms = unified_table.row_terms(rows)
+    term_codes, term_labels = pd.factorize(row_terms)
+    term_labels = unified_table.terms[term_labels]
+
+    n_proteins = len(protein_names)
+    n_terms = len(term_labels)
+    pairs = protein_codes[row_positions] * n_terms + term_codes
+
+    ### (C) Expected and (A) observed counts per protein and CHEMONTID
+    C = np.bincount(
+        pairs,
+        minlength=n_proteins * n_terms).reshape(n_proteins, n_terms)
+    A = np.bincount(
+        pairs[passing[row_positions]],
+        minlength=n_proteins * n_terms).reshape(n_proteins, n_terms)
+
+    ### (B) Unique observed metabolites per protein, less A; (D) library less C
+    observed_metabolites = pd.DataFrame({
+        "protein": protein_codes[passing],
+        "metabolite": metabolite_codes[passing]
+    }).drop_duplicates()
+    OBSERVED_COUNT = np.bincount(
+        observed_metabolites["protein"].to_numpy(),
+        minlength=n_proteins)
+    B = OBSERVED_COUNT[:, None] - A
+    D = library_size - C
+
+    # Remove any substructures where there are 0 or 1 counts to prevent weighting downstream FDR
+    protein_index, term_index = np.nonzero(A > 1)
+    a = A[protein_index, term_index]
+    b = B[protein_index, term_index]
+    c = C[protein_index, term_index]
+    d = D[protein_index, term_index]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold_change = (a / b) / (c / d)
+
+    _, _, twosided = pvalue_npy(
+        a.astype(np.uint32),
+        b.astype(np.uint32),
+        c.astype(np.uint32),
+        d.astype(np.uint32))
+
+    # Benjamini-Hochberg within each protein
+    order = np.lexsort((twosided, protein_index))
+    sorted_proteins = protein_index[order]
+    group_sizes = np.bincount(sorted_proteins, minlength=n_proteins)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    ranks = np.arange(len(order)) - group_starts[sorted_proteins] + 1
+    fdr = twosided[order] * group_sizes[sorted_proteins] / ranks
+    fdr = pd.Series(fdr[::-1]).groupby(sorted_proteins[::-1]).cummin() \
+        .to_numpy()[::-1]
+    fdr = np.minimum(fdr, 1)
+
+    chemontids = np.asarray(term_labels, dtype=object)[term_index[order]]
+    chemontids[chemontids == UNANNOTATED_TERM] = np.nan
+
+    results_table = pd.DataFrame({
+        "query_protein": np.asarray(protein_names, dtype=object)[sorted_proteins],
+        "CHEMONTID": chemontids,
+        "A": a[order],
+        "B": b[order],
+        "C": c[order],
+        "D": d[order],
+        "Fold_change": fold_change[order],
+        "P_value": twosided[order],
+        "FDR": fdr
+    })
+
+    # Add common substructure names to results table 
+    results_table["Term"] = term_names(
+        chemontids=results_table["CHEMONTID"],
+        chemontid_reference=chemontid_reference)
+
+    return results_table
+
+
+def crossref_database_file(
+        database_url,
+        references=REFERENCES,
+        hierarchy=False):
+    """Import a MIDAS table from disk and cross-reference it
+
+    Returns the dataset ID, the cross-referenced MidasTable and the number of
+    unique metabolites in the library
+    """
+    datasets = DatasetRegistry(
+        _path=os.path.dirname(database_url),
+        bundled=())
+    dataset_id = datasets.register_file(
+        os.path.basename(database_url))
+
+    return dataset_id, \
+        datasets.crossref(
+            dataset_id=dataset_id,
+            references=references,
+            hierarchy=hierarchy), \
+        datasets.library_size(dataset_id)
+
+
+def enrich_dataset(
+        dataset_id,
+        TARGET,
+        THRESHOLD,
+        datasets=DATASETS,
+        references=REFERENCES,
+        hierarchy=False):
+    """Run enrichment for a registered dataset and return the results table
+
+    Metabolite annotations are shared across the dataset; only the rows for
+    `TARGET` are cross-referenced, and the resulting contingency table is
+    reused for any later threshold. With `hierarchy`, each metabolite also
+    counts towards every ancestor of its substructure classes.
+    """
+    tables = datasets.contingency(
+        dataset_id=dataset_id,
+        TARGET=TARGET,
+        references=references,
+        hierarchy=hierarchy)
+
+    return score_enrichment(
+        results_table=tables.counts(
+            TARGET=TARGET,
+            THRESHOLD=THRESHOLD),
+        chemontid_reference=references.term_reference(hierarchy),
+        THRESHOLD=THRESHOLD)
+
+
+def __main__(
+        TARGET,
+        THRESHOLD,
+        DATABASE=None,
+        dataset_id=None,
+        references=REFERENCES,
+        datasets=DATASETS,
+        hierarchy=False):
     """
     Import reference files and MIDAS database
     Cross-reference MIDAS with sub-structure annotations
     Output enrichment table for each sub-structure per MIDAS query protein
+
+    Reference files are served from the process-wide `references` cache
+    rather than re-read on every call. The MIDAS database is either passed
+    as a string or file object in `DATABASE` or as the ID of a previously
+    registered dataset in `dataset_id`; the ID is returned in the
+    DATASET_HEADER response header so later calls can skip the upload.
+    `hierarchy` enables parent-class enrichment over the ChemOnt hierarchy.
     """
 
     TARGET = str(TARGET)
     THRESHOLD = float(THRESHOLD)
-    DATABASE = str(DATABASE)
 
     # Import MIDAS database
-    unified_table = import_database_str(
-        database=DATABASE)
+    if DATABASE is not None:
+        dataset_id = datasets.register(DATABASE)
+    else:
+        dataset_id = datasets.resolve(str(dataset_id))
 
-    # Import metabolite reference for HMDB ID mapping between databases
-    metabolite_reference = import_json(
-        _path=DATA_PATH,
-        _file="metabolites.json")
-
-    substructure_dictionary = import_json(
-        _path=DATA_PATH,
-        _file="CHEMONTID-substructure-dictionary.json")
-
-    unified_table = crossref_databases(
-        midas_table=unified_table,
-        substructure_dictionary=substructure_dictionary,
-        metabolite_reference=metabolite_reference)
-
-    chemontid_reference = import_json(
-        _path=DATA_PATH,
-        _file=CHEMONTID_DICTIONARY)
-
-    results = substructure_enrichment(
-        unified_table=unified_table,
-        chemontid_reference=chemontid_reference,
+    results = enrich_dataset(
+        dataset_id=dataset_id,
         TARGET=TARGET,
-        THRESHOLD=THRESHOLD)
+        THRESHOLD=THRESHOLD,
+        datasets=datasets,
+        references=references,
+        hierarchy=bool(hierarchy))
 
     print("----")
     print("Results table:")
@@ -279,7 +1052,9 @@ def __main__(TARGET, THRESHOLD, DATABASE):
     print(results)
     print("----")
 
-    return HttpResponse(results.to_json(), content_type="application/json")
+    response = HttpResponse(results.to_json(), content_type="application/json")
+    response[DATASET_HEADER] = dataset_id
+    return response
 
 if __name__ == '__main__':
     __main__()
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""License Information
+substructure-enrich
+Electrum utility for enrichment analysis of metabolite substructures
+https://github.com/Electrum-app/Electrum/
+alias: substructure-enrich
+
+Copyright (C) 2020-2021 Jordan A. Berg
+Email: jordan<dot>berg<at>biochem<dot>utah<dot>edu
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+You should have received a copy of the GNU General Public License along with
+this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+
+"""Import dependencies
+"""
+import numpy as np
+
+from .columnar import ColumnFile, StringTable, StringTableWriter, save_columns
+from .hmdb import HMDBIndex, normalize_hmdb_id
+
+SUBSTRUCTURE_TABLE = "CHEMONTID-substructure-table.npz"
+SUBSTRUCTURE_COLUMNS = ("hmdb_id", "taxonomy_ids", "taxonomy_terms")
+
+
+"""Classes
+"""
+class SubstructureTable(HMDBIndex):
+    """Columnar substructure reference written by make_structure_dictionary
+
+    Holds the SUBSTRUCTURE_COLUMNS of every HMDB record as string tables,
+    plus `hmdb_number`, the normalized numeric ID of each row (-1 if the ID
+    is not an HMDB ID), and a sorted `index_number` -> `index_row` lookup.
+    Columns are memory-mapped on first use and records are decoded only
+    when looked up, so processes opening the same file share one copy.
+    `get` returns the same records as the JSON dictionary did, with empty
+    fields as NaN.
+    """
+    def __init__(
+            self,
+            columns):
+        self.columns = columns
+        self._tables = {}
+        self._index = None
+
+    @classmethod
+    def load(
+            cls,
+            _path,
+            _file=SUBSTRUCTURE_TABLE):
+        return cls(ColumnFile.load(_path, _file))
+
+    @staticmethod
+    def build_index(
+            hmdb_numbers,
+            id_widths):
+        """Return sorted numeric IDs and their rows, preferring the least
+        padded ID; the last of equal IDs wins, as in the JSON dictionary
+        """
+        numbers = np.asarray(hmdb_numbers, dtype=np.int64)
+        rows = np.arange(len(numbers))
+        order = np.lexsort((-rows, id_widths, numbers))
+        numbers = numbers[order]
+        first = np.ones(len(numbers), dtype=bool)
+        first[1:] = numbers[1:] != numbers[:-1]
+        first &= numbers >= 0
+        return numbers[first], order[first].astype(np.int64)
+
+    @property
+    def index(self):
+        """Sorted numeric HMDB IDs and the row holding each
+        """
+        if self._index is None:
+            if "index_number" in self.columns:
+                self._index = (
+                    self.columns["index_number"], self.columns["index_row"])
+            else:
+                self._index = self.build_index(
+                    self.columns["hmdb_number"],
+                    self.column("hmdb_id").lengths())
+        return self._index
+
+    def find(
+            self,
+            hmdb_id):
+        """Return the row for an HMDB ID, or -1 if it is not present
+        """
+        number = normalize_hmdb_id(hmdb_id)
+        if number is None:
+            return -1
+        numbers, rows = self.index
+        i = np.searchsorted(numbers, number)
+        if i < len(numbers) and numbers[i] == number:
+            return int(rows[i])
+        return -1
+
+    def __contains__(
+            self,
+            hmdb_id):
+        return self.find(hmdb_id) != -1
+
+    def __len__(self):
+        return len(self.index[0])
+
+    def column(
+            self,
+            name):
+        if name not in self._tables:
+            self._tables[name] = StringTable.from_columns(self.columns, name)
+        return self._tables[name]
+
+    def record(
+            self,
+            row):
+        record = {}
+        for c in SUBSTRUCTURE_COLUMNS:
+            value = self.column(c)[row]
+            record[c] = value if value != '' else np.nan
+        return record
+
+    def get(
+            self,
+            hmdb_id,
+            default=None):
+        row = self.find(hmdb_id)
+        if row == -1:
+            return default
+        return self.record(row)
+
+
+class SubstructureTableWriter:
+    """Collect substructure records and write them as a SubstructureTable
+    """
+    def __init__(
+            self,
+            columns=SUBSTRUCTURE_COLUMNS):
+        self.tables = {c: StringTableWriter() for c in columns}
+        self.hmdb_numbers = []
+
+    def append(
+            self,
+            record):
+        """Add a record given as a dictionary of strings
+        """
+        number = normalize_hmdb_id(record["hmdb_id"])
+        self.hmdb_numbers.append(-1 if number is None else number)
+        for c, writer in self.tables.items():
+            writer.append(record[c])
+
+    def save(
+            self,
+            output_file):
+        arrays = {"hmdb_number": np.array(self.hmdb_numbers, dtype=np.int64)}
+        for c, writer in self.tables.items():
+            arrays.update(writer.table().arrays(c))
+        arrays["index_number"], arrays["index_row"] = \
+            SubstructureTable.build_index(
+                arrays["hmdb_number"], np.diff(arrays["hmdb_id_offsets"]))
+        return save_columns(output_file, arrays)
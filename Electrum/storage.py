@@ -0,0 +1,185 @@
+"""Static file storage and serving for the bundled data files
+
+`collectstatic` writes a content-hashed copy of every static file (through
+Django's ManifestStaticFilesStorage) and, for text formats, gzip and brotli
+variants next to both names. `serve_static` returns the smallest variant the
+client accepts, with a one-year immutable Cache-Control for hashed names.
+"""
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import quote_etag
+import mimetypes
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Suffixes worth compressing; images, archives and .npz tables are skipped
+COMPRESSIBLE_SUFFIXES = (
+    ".txt", ".tsv", ".csv", ".json", ".eldb",
+    ".js", ".css", ".html", ".svg", ".map")
+
+# Files smaller than this are served as they are
+MIN_COMPRESS_SIZE = 1024
+
+# A variant is only kept if it saves at least this fraction of the file
+MIN_COMPRESS_RATIO = 0.95
+
+# Preferred first; (Content-Encoding, file suffix)
+ENCODINGS = (
+    ("br", ".br"),
+    ("gzip", ".gz"))
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "public, no-cache"
+
+
+"""Functions
+"""
+def compressible(
+        file_path):
+    """Return True if precompressed variants should be built for a file
+    """
+    return file_path.endswith(COMPRESSIBLE_SUFFIXES) \
+        and os.path.getsize(file_path) >= MIN_COMPRESS_SIZE
+
+
+def compress_file(
+        file_path):
+    """Write the gzip and brotli variants of a file next to it
+
+    Variants that do not save enough are removed. Returns the paths written.
+    """
+    with open(file_path, "rb") as _f:
+        content = _f.read()
+
+    compressors = {
+        "gzip": lambda c: gzip.compress(c, compresslevel=9, mtime=0),
+        "br": brotli.compress if brotli is not None else None,
+    }
+
+    output_files = []
+    for encoding, suffix in ENCODINGS:
+        output_file = file_path + suffix
+        compressor = compressors[encoding]
+        compressed = compressor(content) if compressor is not None else None
+        if compressed is None \
+                or len(compressed) > MIN_COMPRESS_RATIO * len(content):
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+            continue
+
+        temp_file = output_file + ".tmp"
+        with open(temp_file, "wb") as _f:
+            _f.write(compressed)
+        os.replace(temp_file, output_file)
+        output_files.append(output_file)
+
+    return output_files
+
+
+def accepted_encodings(
+        request):
+    """Return the content codings listed in Accept-Encoding (q=0 excluded)
+    """
+    accepted = set()
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                pass
+        if coding.strip() and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def serve_static(
+        request,
+        path,
+        document_root,
+        hashed_names=()):
+    """Serve a collected static file with caching and precompressed variants
+
+    Names in `hashed_names` change whenever their content does, so they are
+    cached as immutable; other names must be revalidated with their ETag.
+    """
+    try:
+        file_path = safe_join(document_root, path)
+    except ValueError:
+        raise Http404("Invalid static file path")
+    if not os.path.isfile(file_path):
+        raise Http404("Static file not found")
+
+    accepted = accepted_encodings(request)
+    served_path = file_path
+    content_encoding = None
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.isfile(file_path + suffix):
+            served_path = file_path + suffix
+            content_encoding = encoding
+            break
+
+    stat = os.stat(served_path)
+    etag = quote_etag("%x-%x%s" % (
+        stat.st_mtime_ns,
+        stat.st_size,
+        "-" + content_encoding if content_encoding else ""))
+    cache_control = IMMUTABLE_CACHE if path in hashed_names \
+        else REVALIDATE_CACHE
+
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = mimetypes.guess_type(file_path)
+        response = FileResponse(
+            open(served_path, "rb"),
+            filename=os.path.basename(file_path),
+            content_type=content_type or "application/octet-stream")
+        response["Content-Length"] = str(stat.st_size)
+        if content_encoding is not None:
+            response["Content-Encoding"] = content_encoding
+
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+"""Classes
+"""
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also precompresses collected files
+
+    Both the original and the content-hashed copy of each text file get
+    `.gz` (and, with the brotli package installed, `.br`) variants.
+    """
+    def post_process(
+            self,
+            paths,
+            dry_run=False,
+            **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+
+        for name in sorted(set(paths) | set(self.hashed_files.values())):
+            file_path = self.path(name)
+            if os.path.isfile(file_path) and compressible(file_path):
+                compress_file(file_path)
+
+    def hashed_names(
+            self):
+        """Return the set of content-hashed names in the manifest
+        """
+        if getattr(self, "_hashed_names", None) is None:
+            self._hashed_names = frozenset(self.hashed_files.values())
+        return self._hashed_names
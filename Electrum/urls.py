@@ -1,4 +1,5 @@
 from django.urls import path
+from django.conf import settings
 
 from . import views
 
@@ -11,4 +12,11 @@ urlpatterns = [
     path('cite', views.CiteView.as_view(), name='cite_name'),
 
     path('ajax/run_substructure/', views.substructure, name='ajax_substructure'),
-]
\ No newline at end of file
+    path('ajax/substructure_job/<str:job_id>/', views.substructure_job, name='ajax_substructure_job'),
+]
+
+# Collected static files, for deployments without a front-end server for
+# STATIC_URL (runserver serves them itself while DEBUG is on)
+if (settings.STATIC_URL or '').startswith('/'):
+    urlpatterns.append(
+        path(settings.STATIC_URL.lstrip('/') + '<path:path>', views.static_file, name='static_file'))
\ No newline at end of file
@@ -1,14 +1,17 @@
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
-from django.http.multipartparser import MultiPartParser
 from django.urls import reverse
 from django.views import generic
 from django.utils import timezone
-
-import re 
+from django.conf import settings
+import math
 
 # Create your views here.
 from .static.Electrum.python.substructure_enrich.substructure_enrich import __main__ as substructure_enrich
+from .static.Electrum.python.substructure_enrich.substructure_enrich import UnknownDataset
+from .static.Electrum.python.substructure_enrich.jobs import JobQueue, JOB_PATH, JOB_WORKERS, JOB_MAX_AGE, JOB_MAX_SIZE
+from .storage import serve_static
+from django.contrib.staticfiles.storage import staticfiles_storage
 
 class IndexView(generic.ListView):
     template_name = 'Electrum/index.html'
@@ -42,35 +45,163 @@ class CiteView(generic.ListView):
 
 from django.views.decorators.csrf import csrf_exempt
 
+# Default cap on substructure enrichment uploads, in bytes
+# (override with ELECTRUM_MAX_UPLOAD_SIZE in settings.py)
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+# Background enrichment runs (ELECTRUM_JOB_PATH, ELECTRUM_JOB_WORKERS,
+# ELECTRUM_JOB_MAX_AGE and ELECTRUM_JOB_MAX_SIZE in settings.py)
+substructure_jobs = JobQueue(
+    _path=getattr(settings, "ELECTRUM_JOB_PATH", JOB_PATH),
+    max_workers=getattr(settings, "ELECTRUM_JOB_WORKERS", JOB_WORKERS),
+    max_age=getattr(settings, "ELECTRUM_JOB_MAX_AGE", JOB_MAX_AGE),
+    max_size=getattr(settings, "ELECTRUM_JOB_MAX_SIZE", JOB_MAX_SIZE))
+
 @csrf_exempt 
 def substructure(
-        request,
-        _start="Content-Disposition: form-data;",
-        _end="------WebKitFormBoundary"):
-
-    items = re.findall(
-        r'{0}(.*?){1}'.format(_start, _end), 
-        request.POST["this_data"], 
-        flags=re.DOTALL | re.MULTILINE)
-
-    _obj = {}
-    for i in items:
-        key = re.findall(
-            r'{0}(.*?){1}'.format("\ name=\"", "\""), 
-            i, 
-            flags=re.DOTALL | re.MULTILINE)[0]
-        value = i.split("\r\n\r\n")[1]
-        _obj[key] = value
+        request):
+    """Run substructure enrichment for a posted MIDAS table or dataset ID
+
+    The request is parsed as regular multipart form data. Django streams the
+    `file` part to its upload handlers (spilling to a temporary file above
+    FILE_UPLOAD_MAX_MEMORY_SIZE) and the resulting file object is passed
+    straight to the table reader.
+
+    With `async` set to "true" the run is queued instead and the job ID is
+    returned with status 202; poll `substructure_job` for the results.
+    """
+    max_upload_size = getattr(
+        settings, "ELECTRUM_MAX_UPLOAD_SIZE", MAX_UPLOAD_SIZE)
+
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > max_upload_size:
+        return JsonResponse(
+            {"error": "Upload exceeds maximum size of %d bytes" % max_upload_size},
+            status=413)
+
+    upload = request.FILES.get("file")
+    if upload is not None and upload.size > max_upload_size:
+        return JsonResponse(
+            {"error": "Upload exceeds maximum size of %d bytes" % max_upload_size},
+            status=413)
+
+    # Enrichment can run against a table registered by an earlier request,
+    # in which case only the dataset ID is posted
+    dataset_id = request.POST.get("dataset_id", "").strip() or None
+    if request.POST.get("async", "").strip() == "true":
+        return submit_substructure(request, upload, dataset_id)
+
+    if upload is not None or dataset_id is None:
+        dataset_id = None
 
     try:
         results = substructure_enrich(
-            _obj["protein"].strip(), 
-            _obj["threshold"].strip(), 
-            _obj["file"])
+            request.POST["protein"].strip(), 
+            request.POST["threshold"].strip(), 
+            DATABASE=None if dataset_id else request.FILES["file"],
+            dataset_id=dataset_id,
+            hierarchy=request.POST.get("hierarchy", "").strip() == "true")
+    except UnknownDataset:
+        # The dataset may also be evicted from the registry between requests
+        # or while this one runs, so it is only looked up here
+        return JsonResponse(
+            {"error": "Unknown dataset", "dataset_id": dataset_id},
+            status=404)
     except (KeyError):
         raise Exception("Unable to run substructure enrichment analysis.")
     else:
         # Always return an HttpResponseRedirect after successfully dealing
         # with POST data. This prevents data from being posted twice if a
         # user hits the Back button.
-        return results
\ No newline at end of file
+        return results
+
+def submit_substructure(
+        request,
+        upload,
+        dataset_id):
+    """Queue a substructure enrichment run and return its job ID
+
+    Missing or invalid form fields return status 400 and unknown dataset IDs
+    status 404.
+    """
+    protein = request.POST.get("protein", "").strip()
+    threshold = request.POST.get("threshold", "").strip()
+    if protein == "":
+        return JsonResponse(
+            {"error": "Missing protein"},
+            status=400)
+    try:
+        threshold = float(threshold)
+        if not math.isfinite(threshold):
+            raise ValueError(threshold)
+    except ValueError:
+        return JsonResponse(
+            {"error": "Invalid threshold", "threshold": threshold},
+            status=400)
+    if upload is None and dataset_id is None:
+        return JsonResponse(
+            {"error": "Missing file or dataset_id"},
+            status=400)
+
+    if upload is not None:
+        dataset_id = substructure_jobs.spool(upload)
+
+    try:
+        job_id = substructure_jobs.submit(
+            dataset_id,
+            protein,
+            threshold,
+            hierarchy=request.POST.get("hierarchy", "").strip() == "true")
+    except (KeyError):
+        return JsonResponse(
+            {"error": "Unknown dataset", "dataset_id": dataset_id},
+            status=404)
+
+    return JsonResponse(
+        {"job_id": job_id, "dataset_id": dataset_id, "status": "pending"},
+        status=202)
+
+def substructure_job(
+        request,
+        job_id):
+    """Return the state of a queued substructure enrichment run
+
+    Finished jobs return the results table, pending jobs status 202, failed
+    jobs status 500 and unknown or expired jobs status 404.
+    """
+    try:
+        state, payload = substructure_jobs.status(job_id)
+    except (KeyError):
+        return JsonResponse(
+            {"error": "Unknown job", "job_id": job_id},
+            status=404)
+
+    if state == "done":
+        return HttpResponse(payload, content_type="application/json")
+    elif state == "failed":
+        return JsonResponse(
+            {"job_id": job_id, "status": state, "error": payload},
+            status=500)
+    else:
+        return JsonResponse(
+            {"job_id": job_id, "status": state},
+            status=202)
+
+def static_file(
+        request,
+        path):
+    """Serve a collected static file when no front-end server handles STATIC_URL
+
+    Content-hashed names written by collectstatic are sent with a one-year
+    immutable Cache-Control, and the .br/.gz variants are used when the
+    client accepts them (see storage.py).
+    """
+    hashed_names = getattr(staticfiles_storage, "hashed_names", frozenset)()
+    return serve_static(
+        request,
+        path,
+        document_root=settings.STATIC_ROOT,
+        hashed_names=hashed_names)